@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Kernel startup latency benchmark for each envkernel mode.
+
+For each mode, a kernel is installed into a temporary prefix and then
+launched through jupyter_client, like Jupyter does.  The time from
+launch until the first kernel_info_reply is measured, over repeated
+launches.  To make this runnable on any Linux box, stand-in `docker`,
+`singularity` and Lmod executables are used: they do the argument
+handling and then run the kernel directly on the host.
+
+Three numbers are reported for each mode (p50/p95/max, milliseconds):
+
+  total:     launch until kernel_info_reply
+  envkernel: envkernel's own overhead, measured by running the
+             kernel's argv with the kernel command replaced by `true`
+  kernel:    a plain ipykernel without envkernel, for comparison
+
+Usage: python benchmarks/startup.py [-n REPEAT] [--isolate] [MODE ...]
+"""
+
+import argparse
+import json
+import os
+from os.path import join as pjoin
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENVKERNEL = pjoin(os.path.dirname(HERE), 'envkernel.py')
+MODES = ['conda', 'virtualenv', 'lmod', 'docker', 'singularity']
+
+
+FAKE_DOCKER = """\
+#!{python}
+# Stand-in for `docker run`: skip the options, run the command on the host.
+import os, sys
+args = sys.argv[1:]
+assert args.pop(0) == 'run'
+flags = {{'--rm', '-i', '-t', '-d'}}
+while args[0].startswith('-'):
+    opt = args.pop(0)
+    if opt not in flags and '=' not in opt:
+        args.pop(0)
+image = args.pop(0)
+os.execvp(args[0], args)
+"""
+
+FAKE_SINGULARITY = """\
+#!{python}
+# Stand-in for `singularity exec`: apply the --bind mounts to the
+# arguments, then run the command on the host.
+import os, sys
+args = sys.argv[1:]
+assert args.pop(0) == 'exec'
+flags = {{'--contain', '-c', '--cleanenv', '-e'}}
+binds = {{}}
+while args[0].startswith('-'):
+    opt = args.pop(0)
+    if opt in flags or '=' in opt:
+        continue
+    value = args.pop(0)
+    if opt in ('--bind', '-B') and ':' in value:
+        src, dst = value.split(':')[:2]
+        binds[dst] = src
+image = args.pop(0)
+args = [binds.get(x, x) for x in args]
+os.execvp(args[0], args)
+"""
+
+FAKE_LMOD = """\
+#!/bin/sh
+# Stand-in for $LMOD_PKG/libexec/lmod: `lmod python load MOD...`
+shift
+echo "os.environ['LOADEDMODULES'] = '$*'"
+"""
+
+
+def write_script(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+    os.chmod(path, 0o755)
+
+
+def make_stand_ins(d):
+    """Create the stand-in tools and environments, return env changes."""
+    bindir = pjoin(d, 'bin')
+    os.makedirs(bindir)
+    write_script(pjoin(bindir, 'docker'), FAKE_DOCKER.format(python=sys.executable))
+    write_script(pjoin(bindir, 'singularity'), FAKE_SINGULARITY.format(python=sys.executable))
+    lmod_pkg = pjoin(d, 'lmod')
+    os.makedirs(pjoin(lmod_pkg, 'libexec'))
+    write_script(pjoin(lmod_pkg, 'libexec', 'lmod'), FAKE_LMOD)
+    os.makedirs(pjoin(d, 'modules'))
+    # An "environment" whose python is this one
+    pyenv = pjoin(d, 'pyenv')
+    os.makedirs(pjoin(pyenv, 'bin'))
+    os.symlink(sys.executable, pjoin(pyenv, 'bin', 'python'))
+    return {
+        'PATH': bindir + os.pathsep + os.path.dirname(sys.executable) + os.pathsep + os.environ['PATH'],
+        'LMOD_PKG': lmod_pkg,
+        'MODULEPATH': pjoin(d, 'modules'),
+        'JUPYTER_PATH': pjoin(d, 'share', 'jupyter'),
+        }
+
+
+def install(d, mode, name, isolate=False):
+    target = {
+        'conda': pjoin(d, 'pyenv'),
+        'virtualenv': pjoin(d, 'pyenv'),
+        'lmod': 'testmodule',
+        'docker': 'testimage',
+        'singularity': 'testimage.sif',
+        }[mode]
+    cmd = [sys.executable, ENVKERNEL, mode, '--name', name, '--prefix', d,
+           '--python', sys.executable]
+    if isolate:
+        cmd.append('--isolate')
+    cmd.append(target)
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return json.load(open(pjoin(d, 'share', 'jupyter', 'kernels', name, 'kernel.json')))
+
+
+def install_plain(d, name):
+    kernel_dir = pjoin(d, 'share', 'jupyter', 'kernels', name)
+    os.makedirs(kernel_dir)
+    with open(pjoin(kernel_dir, 'kernel.json'), 'w') as f:
+        json.dump({'argv': [sys.executable, '-m', 'ipykernel_launcher', '-f', '{connection_file}'],
+                   'display_name': name, 'language': 'python'}, f)
+
+
+def time_launch(name):
+    """Launch a kernel, return seconds until the first kernel_info_reply"""
+    import jupyter_client
+    km = jupyter_client.KernelManager(kernel_name=name)
+    start = time.perf_counter()
+    km.start_kernel(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        # The request is queued until the kernel is listening, so this
+        # times the first reply (wait_for_ready() only polls each second).
+        msg_id = kc.kernel_info()
+        while True:
+            reply = kc.get_shell_msg(timeout=60)
+            if reply['parent_header'].get('msg_id') == msg_id:
+                return time.perf_counter() - start
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+
+
+def time_envkernel(d, name, kernel):
+    """Run envkernel's run mode with `true` as the kernel, return seconds"""
+    conn = pjoin(d, 'connection.json')
+    with open(conn, 'w') as f:
+        json.dump({'shell_port': 1, 'iopub_port': 2, 'stdin_port': 3, 'control_port': 4,
+                   'hb_port': 5, 'ip': '127.0.0.1', 'transport': 'tcp'}, f)
+    argv = kernel['argv']
+    argv = argv[:argv.index('--')+1] + ['true', '-f', conn]
+    # Like jupyter_client, so that the launch plan is used.
+    resource_dir = pjoin(d, 'share', 'jupyter', 'kernels', name)
+    argv = [x.replace('{connection_file}', conn).replace('{resource_dir}', resource_dir)
+            for x in argv]
+    start = time.perf_counter()
+    subprocess.check_call(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def summary(times):
+    times = sorted(x*1000 for x in times)
+    p95 = times[min(len(times)-1, int(round(.95*(len(times)-1))))]
+    return statistics.median(times), p95, times[-1]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modes', nargs='*', default=MODES)
+    parser.add_argument('-n', '--repeat', type=int, default=10,
+                        help="Launches per mode (default 10)")
+    parser.add_argument('--isolate', action='store_true',
+                        help="Install the kernels with envkernel --isolate")
+    parser.add_argument('--json', action='store_true', help="Output JSON")
+    args = parser.parse_args(argv)
+
+    results = { }
+    with tempfile.TemporaryDirectory(prefix='envkernel-bench-') as d:
+        environ = dict(os.environ)
+        os.environ.update(make_stand_ins(d))
+        os.environ['ENVKERNEL_CACHE_DIR'] = pjoin(d, 'cache')
+        try:
+            install_plain(d, 'bench-plain')
+            time_launch('bench-plain')  # warm up caches
+            results['kernel'] = {'total': [time_launch('bench-plain') for _ in range(args.repeat)]}
+            for mode in args.modes:
+                name = 'bench-'+mode
+                kernel = install(d, mode, name, isolate=args.isolate)
+                results[mode] = {
+                    'total': [time_launch(name) for _ in range(args.repeat)],
+                    'envkernel': [time_envkernel(d, name, kernel) for _ in range(args.repeat)],
+                    }
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    if args.json:
+        print(json.dumps({mode: {k: summary(v) for k, v in r.items()}
+                          for mode, r in results.items()}, indent=1))
+        return 0
+    print('%-12s %-10s %8s %8s %8s'%('mode', 'stage', 'p50', 'p95', 'max'))
+    for mode, r in results.items():
+        for stage, times in r.items():
+            print('%-12s %-10s %8.1f %8.1f %8.1f'%(mode, stage, *summary(times)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
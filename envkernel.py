@@ -1,23 +1,58 @@
 #!/usr/bin/env python3
 
-import argparse
-import copy
-import glob
-import json
-import logging
+# envkernel is re-executed at every kernel start, so only the modules
+# needed by everything are imported here.  Everything else is imported
+# in the function that uses it, so that the run mode only pays for
+# what it needs.
 import os
 from os.path import join as pjoin
-import re
-import shlex
-import shutil
-import subprocess
 import sys
-import tempfile
-import textwrap
 
-LOG = logging.getLogger('envkernel')
-LOG.setLevel(logging.INFO)
-logging.lastResort.setLevel(logging.DEBUG)
+# Same values as in logging
+DEBUG = 10
+INFO = 20
+WARNING = 30
+CRITICAL = 50
+
+class _Log():
+    """The 'envkernel' logger, importing logging only when first used.
+
+    Importing logging takes longer than everything else the run mode
+    does.  In run mode (after stderr_only()), messages are written
+    directly to stderr, which is what logging.lastResort does anyway.
+    """
+    def __init__(self, level=INFO):
+        self.level = level
+        self._logger = None
+        self._stderr_only = False
+    def _get_logger(self):
+        if self._logger is None:
+            import logging
+            self._logger = logging.getLogger('envkernel')
+            self._logger.setLevel(self.level)
+            logging.lastResort.setLevel(logging.DEBUG)
+        return self._logger
+    def stderr_only(self):
+        self._stderr_only = True
+    def setLevel(self, level):
+        self.level = level
+        if self._logger is not None:
+            self._logger.setLevel(level)
+    def log(self, level, msg, *args):
+        if not self._stderr_only:
+            self._get_logger().log(level, msg, *args)
+        elif level >= self.level:
+            sys.stderr.write((msg % args if args else msg) + '\n')
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+    def critical(self, msg, *args):
+        self.log(CRITICAL, msg, *args)
+
+LOG = _Log()
 
 
 version_info = (1, 1, 0,) # 'dev0')
@@ -77,26 +112,997 @@ def find_connection_file(args):
 
 
 def path_join(*args):
-    """Join the arguments using ':', like the PATH environment variable"""
-    if len(args) == 1:
-        return args[0]
-    if args[1] is None or args[1] == '':
-        return path_join(args[0], *args[2:])
-    path = os.pathsep.join([args[0], args[1]])
-    return path_join(path, *args[2:])
+    """Join the arguments using ':', like the PATH environment variable.
+
+    Repeated directories are removed (see clean_path)."""
+    return clean_path(os.pathsep.join([args[0], *(x for x in args[1:] if x)]))
+
+
+def clean_path(value, prune=False):
+    """Remove repeated directories from a PATH-like value, keeping the first.
+
+    With prune, also remove directories which don't exist.  Each entry
+    makes every lookup in the path (exec, dlopen, import) do one more
+    stat, which is slow on network filesystems."""
+    seen = set()
+    parts = [ ]
+    for part in value.split(os.pathsep):
+        key = os.path.normpath(part) if part else part
+        if key in seen:
+            continue
+        seen.add(key)
+        if prune and part and not os.path.exists(part):
+            continue
+        parts.append(part)
+    return os.pathsep.join(parts)
+
+
+# Variables cleaned by --prune-paths
+PATH_VARS = ('PATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH', 'CPATH', 'PYTHONPATH', 'PKG_CONFIG_PATH')
 
 
 def printargs(args):
+    import shlex
     return ' '.join(shlex.quote(x) for x in args)
 
 
 
+# Caching of environment changes.  Some modes (Lmod, ...) are slow to
+# compute what they do to the environment, but the result only
+# depends on a few inputs.  These helpers store the resulting
+# environment delta in a cache directory.  A delta is a dict
+# {NAME: new_value}, with new_value None if NAME is removed.
+
+CACHE_MAX_SIZE = 64  # MB
+# Environment variables which change each launch but don't affect the
+# result, so are excluded from cache keys.
+CACHE_IGNORE_ENV = {'PWD', 'OLDPWD', 'SHLVL', '_', 'COLUMNS', 'LINES'}
+CACHE_IGNORE_ENV_PREFIX = 'JPY_'
+
+
+def cache_dir(*parts, base=None):
+    """Return (and create) a directory within the envkernel cache.
+
+    The base is, in order, `base`, $ENVKERNEL_CACHE_DIR,
+    $XDG_CACHE_HOME/envkernel, or ~/.cache/envkernel."""
+    if base is None:
+        base = os.environ.get('ENVKERNEL_CACHE_DIR')
+    if base is None:
+        base = pjoin(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                     'envkernel')
+    path = pjoin(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_key(*items):
+    """Hash of arbitrary JSON-able items, for use as a cache filename"""
+    import hashlib
+    import json
+    data = json.dumps(items, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def environ_key(environ=None):
+    """The parts of the environment which go into cache keys"""
+    if environ is None:
+        environ = os.environ
+    return sorted((k, v) for (k, v) in environ.items()
+                  if not cache_ignored(k))
+
+
+def cache_ignored(name):
+    return name in CACHE_IGNORE_ENV or name.startswith(CACHE_IGNORE_ENV_PREFIX)
+
+
+def mtimes(paths):
+    """List of (path, mtime) for paths, mtime None if it doesn't exist"""
+    ret = [ ]
+    for path in paths:
+        try:
+            ret.append((path, os.stat(path).st_mtime))
+        except OSError:
+            ret.append((path, None))
+    return ret
+
+
+class locked():
+    """Context manager holding an exclusive lock on a lock file.
+
+    Used so that only one process computes a cache entry while others
+    wait for it.  With shared=True, the lock is shared with other
+    shared holders, and only excludes exclusive ones."""
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+    def acquire(self, blocking=True):
+        """Take the lock.  Without blocking, return False if it is held.
+
+        cache_evict removes lock files (while holding them), so after
+        waiting, check that the file locked is still the one at path."""
+        import fcntl
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        while True:
+            self.fd = os.open(self.path, os.O_RDWR|os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(self.fd, mode if blocking else mode|fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self.fd)
+                return False
+            try:
+                if os.path.samestat(os.fstat(self.fd), os.stat(self.path)):
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(self.fd)
+    def release(self):
+        os.close(self.fd)  # closing releases the lock
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, *exc):
+        self.release()
+
+
+def write_private(path, data):
+    """Write data (a str) to a file only the user can read.
+
+    For copies of connection files, which contain the kernel's key."""
+    fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        os.fchmod(fd, 0o600)  # if it existed already
+        f.write(data)
+
+
+def write_atomic(path, data):
+    """Write data (a str) to path, atomically replacing it."""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.tmp-'+os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def rename_exchange(a, b):
+    """Atomically exchange paths a and b (Linux renameat2).
+
+    Returns False, without changing anything, if this is not supported
+    (not Linux, an old C library or kernel, or the filesystem)."""
+    import ctypes
+    import errno
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    AT_FDCWD, RENAME_EXCHANGE = -100, 2
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err), a)
+
+
+def cache_evict(directory, max_size, suffix='.json', min_age=0):
+    """Remove least recently used entries until under max_size (MB).
+
+    Entries used (accessed or modified) in the last min_age seconds
+    are kept, since a process may be just about to open them."""
+    import time
+    entries = [ ]
+    total = 0
+    now = time.time()
+    for fname in os.listdir(directory):
+        if not fname.endswith(suffix) or fname.startswith('.tmp-'):
+            continue
+        try:
+            st = os.stat(pjoin(directory, fname))
+        except OSError:
+            continue
+        total += st.st_size
+        if now - max(st.st_atime, st.st_mtime) < min_age:
+            continue
+        entries.append((st.st_mtime, st.st_size, fname))
+    entries.sort()
+    while entries and total > max_size * 2**20:
+        _, size, fname = entries.pop(0)
+        LOG.debug('cache: evicting %s', fname)
+        try:
+            os.unlink(pjoin(directory, fname))
+        except OSError:
+            pass
+        # The lock file goes too, but only if nobody holds or waits
+        # for it (see locked.acquire).
+        lock = locked(pjoin(directory, fname[:-len(suffix)]+'.lock'))
+        try:
+            if lock.acquire(blocking=False):
+                try:
+                    os.unlink(lock.path)
+                finally:
+                    lock.release()
+        except OSError:
+            pass
+        total -= size
+
+
+def lib_cache(path, base=None):
+    """Return a directory of links to the libraries in a LD_LIBRARY_PATH.
+
+    Each library name links to its first match in the path, so the
+    directory can replace the path, and the dynamic linker then looks
+    in one directory instead of all of them.  The directory is made
+    once and reused until one of the path's directories changes.
+    Returns None if it can't be made."""
+    import shutil
+    import tempfile
+    try:
+        directory = cache_dir('lib-cache', base=base)
+    except OSError as e:
+        LOG.warning('lib-cache: can not use cache dir (%s)', e)
+        return None
+    dirs = [ ]
+    for dir_ in path.split(os.pathsep):
+        # An inherited environment may already use a link directory:
+        # use the path it was made from instead.
+        if os.path.dirname(dir_) == directory:
+            try:
+                dirs.extend(open(pjoin(dir_, '.path')).read().split(os.pathsep))
+                continue
+            except OSError:
+                pass
+        dirs.append(dir_)
+    dirs = [x for x in clean_path(os.pathsep.join(dirs)).split(os.pathsep) if x]
+    prefix = cache_key(dirs)[:16]
+    name = prefix + '-' + cache_key(mtimes(dirs))[:16]
+    dest = pjoin(directory, name)
+    if os.path.isdir(dest):
+        return dest
+    LOG.debug('lib-cache: making %s for %s', dest, path)
+    try:
+        tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+        for dir_ in dirs:
+            try:
+                fnames = os.listdir(dir_)
+            except OSError:
+                continue
+            for fname in fnames:
+                if ('.so' in fname or fname.endswith('.dylib')) \
+                        and not os.path.lexists(pjoin(tmp, fname)):
+                    os.symlink(pjoin(os.path.abspath(dir_), fname), pjoin(tmp, fname))
+        with open(pjoin(tmp, '.path'), 'w') as f:
+            f.write(os.pathsep.join(dirs))
+        os.rename(tmp, dest)
+    except OSError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if os.path.isdir(dest):  # Made by someone else at the same time
+            return dest
+        LOG.warning('lib-cache: could not make %s (%s)', dest, e)
+        return None
+    # Older versions for the same path are not needed anymore.
+    for old in os.listdir(directory):
+        if old.startswith(prefix+'-') and old != name:
+            shutil.rmtree(pjoin(directory, old), ignore_errors=True)
+    return dest
+
+
+def env_delta(before, after):
+    """Return the changes between two environment dicts"""
+    delta = {k: v for (k, v) in after.items() if before.get(k) != v}
+    delta.update({k: None for k in before if k not in after})
+    return delta
+
+
+def apply_env_delta(delta, environ=None):
+    """Apply a delta (from env_delta) to os.environ"""
+    if environ is None:
+        environ = os.environ
+    for name, value in delta.items():
+        if value is None:
+            environ.pop(name, None)
+        else:
+            environ[name] = value
+
+
+def cached_env_delta(kind, key, compute, directory=None, max_size=CACHE_MAX_SIZE):
+    """Return an environment delta, from cache or by calling compute().
+
+    kind: subdirectory of the cache to use
+    key: JSON-able data which fully determines the result
+    compute: function returning the delta, called on a cache miss
+
+    If several processes miss the same key at the same time, only one
+    runs compute() and the others wait for its result.  If the cache
+    can not be used, compute() is called directly.
+    """
+    import json
+    try:
+        directory = cache_dir(kind, base=directory)
+    except OSError as e:
+        LOG.warning('cache: can not use cache dir (%s), not caching', e)
+        return compute()
+    hash_ = cache_key(key)
+    path = pjoin(directory, hash_+'.json')
+    def read():
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('key') != json.loads(json.dumps(key)):
+            return None
+        try:
+            os.utime(path)  # Mark as recently used for eviction.
+        except OSError:
+            pass
+        LOG.debug('cache: hit %s/%s', kind, hash_)
+        return data['delta']
+    delta = read()
+    if delta is not None:
+        return delta
+    lock = locked(pjoin(directory, hash_+'.lock'))
+    try:
+        lock.acquire()
+    except OSError as e:
+        LOG.warning('cache: can not lock %s (%s), not caching', path, e)
+        return compute()
+    try:
+        # Someone else may have computed it while we waited for the lock.
+        delta = read()
+        if delta is not None:
+            return delta
+        LOG.debug('cache: miss %s/%s', kind, hash_)
+        delta = compute()
+        try:
+            write_atomic(path, json.dumps({'key': key, 'delta': delta}))
+            cache_evict(directory, max_size)
+        except OSError as e:
+            LOG.warning('cache: could not write %s (%s)', path, e)
+        return delta
+    finally:
+        lock.release()
+
+
+def run_detached(func, *args):
+    """Run func(*args) in a detached background process.
+
+    The run mode replaces itself with the kernel using exec, so
+    anything that must happen later (cleanup, refilling pools) is done
+    in a double-forked process, which does not stay our child and does
+    not hold our stdout."""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        func(*args)
+    except BaseException as e:
+        LOG.warning('envkernel: background task failed: %r', e)
+    finally:
+        os._exit(0)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def wait_pid(pid, interval=1):
+    """Wait for a process which isn't our child to exit"""
+    import time
+    while pid_alive(pid):
+        time.sleep(interval)
+
+
+def remove_after_exit(pid, paths):
+    """Wait for process pid to exit, then remove paths"""
+    import shutil
+    wait_pid(pid)
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+
+# ioctl(2) request to clone (reflink) a whole file, from linux/fs.h
+FICLONE = 0x40049409
+STAGE_WORKERS = 8
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def stage_tree(src, dst, method='auto', exclude=(), max_size=None, workers=STAGE_WORKERS,
+               reuse=None):
+    """Make a private copy of directory src at dst, as quickly as possible.
+
+    method is `auto` (reflink each file if the filesystem supports it,
+    otherwise copy), `hardlink` (hardlink each file, sharing its data
+    with the original), or `copy`.  Files are copied in parallel.
+    Files and directories whose name or relative path matches a glob
+    in `exclude` are skipped, symlinks are copied as symlinks.  If the
+    files total more than max_size bytes, RuntimeError is raised
+    before anything is copied.  Returns the number of bytes staged.
+
+    reuse is an earlier copy of src: files in it with the same size and
+    mtime as in src are hardlinked from it instead of copied again."""
+    import errno
+    import fnmatch
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    def excluded(rel):
+        return any(fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(os.path.basename(rel), pat)
+                   for pat in exclude)
+
+    dirs, links, files = [ ], [ ], [ ]
+    size = 0
+    for root, dirnames, fnames in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dirs.append(rel)
+        for name in list(dirnames):
+            if excluded(os.path.normpath(pjoin(rel, name))):
+                dirnames.remove(name)
+            elif os.path.islink(pjoin(root, name)):
+                dirnames.remove(name)
+                links.append(pjoin(rel, name))
+        for name in fnames:
+            relname = os.path.normpath(pjoin(rel, name))
+            if excluded(relname):
+                continue
+            if os.path.islink(pjoin(root, name)):
+                links.append(relname)
+                continue
+            files.append(relname)
+            size += os.lstat(pjoin(root, name)).st_size
+    if max_size is not None and size > max_size:
+        raise RuntimeError("%s is %d MB, more than the limit of %d MB to copy"%(
+                           src, size//2**20, max_size//2**20))
+
+    for rel in dirs:
+        os.makedirs(pjoin(dst, rel), exist_ok=True)
+    for rel in links:
+        os.symlink(os.readlink(pjoin(src, rel)), pjoin(dst, rel))
+
+    # Reflinks are tried until the first one fails with an error
+    # meaning that this filesystem (pair) doesn't support them.
+    state = {'reflink': method == 'auto', 'hardlink': method == 'hardlink'}
+    unsupported = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS}
+    def stage(rel):
+        s, t = pjoin(src, rel), pjoin(dst, rel)
+        if reuse is not None:
+            try:
+                st_s, st_r = os.stat(s), os.lstat(pjoin(reuse, rel))
+                if (st_s.st_size, st_s.st_mtime_ns) == (st_r.st_size, st_r.st_mtime_ns):
+                    os.link(pjoin(reuse, rel), t)
+                    return
+            except OSError:
+                pass
+        if state['hardlink']:
+            try:
+                os.link(s, t)
+                return
+            except OSError:
+                state['hardlink'] = False
+        if state['reflink']:
+            try:
+                _reflink(s, t)
+                shutil.copystat(s, t)
+                return
+            except OSError as e:
+                if e.errno not in unsupported:
+                    raise
+                state['reflink'] = False
+        shutil.copy2(s, t)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the first exception from the workers.
+        list(pool.map(stage, files))
+    for rel in reversed(dirs):
+        shutil.copystat(pjoin(src, rel), pjoin(dst, rel))
+    LOG.debug('stage_tree: %s -> %s: %d files, %d bytes (%s)', src, dst, len(files), size,
+              'reflink' if state['reflink'] else 'hardlink' if state['hardlink'] else 'copy')
+    return size
+
+
+# Node-local staging of files from shared filesystems
+STAGE_MAX_SIZE = 20480  # MB
+# Staged files used this recently (seconds) are not evicted: a start
+# which has chosen one may not have opened it yet.
+STAGE_MIN_AGE = 10
+
+
+def check_private(path, mode=0o700):
+    """Raise OSError unless path is ours, not a symlink, and has mode.
+
+    Staged copies are run, and the default stage directory is in /tmp,
+    where someone else could have made it (or a link) first."""
+    import stat
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or st.st_uid != os.getuid() \
+            or stat.S_IMODE(st.st_mode) != mode:
+        raise PermissionError("%s is not private to this user (a symlink, someone "
+                              "else's, or not mode %o)"%(path, mode))
+
+
+def private_dir(path):
+    """Create directory path (mode 0700) if needed, and check_private() it."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    check_private(path)
+    return path
+
+
+def stage_dir(*parts, base=None):
+    """Return (and create) a directory for node-local copies.
+
+    The base is, in order, `base`, $ENVKERNEL_STAGE_DIR, or
+    envkernel-stage-UID in the system temporary directory, since the
+    cache directory is usually in the (shared) home directory.  The
+    base and each part must be private to the user (see
+    check_private), otherwise OSError is raised."""
+    import tempfile
+    if base is None:
+        base = os.environ.get('ENVKERNEL_STAGE_DIR')
+    if base is None:
+        base = pjoin(tempfile.gettempdir(), 'envkernel-stage-%d'%os.getuid())
+    base = os.path.abspath(base)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    path = private_dir(base)
+    for part in parts:
+        path = private_dir(pjoin(path, part))
+    return path
+
+
+def file_sha256(path):
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stage_file(src, directory, max_size=STAGE_MAX_SIZE, sha256=None):
+    """Return a local copy of file src in directory, copying it at first use.
+
+    Copies are keyed by the path, size and mtime of src (and sha256,
+    if given), so a changed src is copied again.  If several processes
+    need the same copy at the same time, one copies and the others
+    wait.  The least recently used copies are removed to keep the
+    directory under max_size (MB).  If src can't be copied (too big,
+    no space, checksum mismatch), src itself is returned.  A copy
+    which isn't the user's own (see check_private) is never used."""
+    import shutil
+    import tempfile
+    src = os.path.abspath(src)
+    st = os.stat(src)
+    if st.st_size > max_size * 2**20:
+        LOG.info('stage: %s is bigger than the limit of %d MB, not copying', src, max_size)
+        return src
+    key = cache_key(src, st.st_size, st.st_mtime, sha256)
+    dest = pjoin(directory, key+'.img')
+    def hit():
+        try:
+            check_private(dest, 0o644)  # See stage_dir
+            os.utime(dest)  # Mark as recently used for eviction.
+        except OSError:
+            return False
+        LOG.debug('stage: using %s for %s', dest, src)
+        return True
+    if hit():
+        return dest
+    with locked(pjoin(directory, key+'.lock')):
+        if hit():
+            return dest
+        # Only one process evicts at a time.
+        with locked(pjoin(directory, '.lock')):
+            cache_evict(directory, max_size - st.st_size/2**20, suffix='.img',
+                        min_age=STAGE_MIN_AGE)
+        LOG.info('stage: copying %s to %s', src, dest)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            if sha256 is not None and file_sha256(tmp) != sha256:
+                LOG.warning('stage: %s does not have the expected checksum, not using a copy', src)
+                os.unlink(tmp)
+                return src
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, dest)
+        except OSError as e:
+            LOG.warning('stage: could not copy %s (%s), using it directly', src, e)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return src
+    return dest
+
+
+def staged_versions(directory):
+    """All staged environment versions: [(last used, size, path, users)]
+
+    Each environment has a directory with one directory per version,
+    containing the copy, its `size` (written last, when the copy is
+    complete, and touched at each use), and `pids` of the kernels
+    using it."""
+    versions = [ ]
+    for env in os.listdir(directory):
+        if env.startswith('.') or not os.path.isdir(pjoin(directory, env)):
+            continue
+        for version in os.listdir(pjoin(directory, env)):
+            path = pjoin(directory, env, version)
+            try:
+                st = os.stat(pjoin(path, 'size'))
+                with open(pjoin(path, 'size')) as f:
+                    size = int(f.read())
+                pids = os.listdir(pjoin(path, 'pids'))
+            except (OSError, ValueError):
+                continue
+            users = [ ]
+            for pid in pids:
+                if pid_alive(int(pid)):
+                    users.append(int(pid))
+                else:
+                    try:
+                        os.unlink(pjoin(path, 'pids', pid))
+                    except OSError:
+                        pass
+            versions.append((st.st_mtime, size, path, users))
+    return sorted(versions)
+
+
+def stage_environment(path, directory, fingerprint, max_size=STAGE_MAX_SIZE):
+    """Return a local copy of the environment (directory) at path.
+
+    The copy is made at first use, and again when fingerprint changes.
+    A new version is made next to the old one, hardlinking the files
+    which haven't changed, so kernels still running from the old
+    version are not disturbed.  Versions no kernel uses are removed
+    when they are replaced or, least recently used first, to keep the
+    total under max_size (MB).  If the environment can't be copied,
+    path itself is returned.
+
+    Starts register in a version (its `pids`) holding the stage
+    directory's lock shared, and removal holds it exclusively, so a
+    version is never removed under a kernel which just chose it."""
+    import shutil
+    import tempfile
+    env_dir = pjoin(directory, cache_key(os.path.abspath(path))[:16])
+    version = pjoin(env_dir, cache_key(fingerprint)[:16])
+    dest = pjoin(version, os.path.basename(path.rstrip('/')))
+    def use():
+        try:
+            check_private(env_dir)
+            check_private(version)
+            with locked(pjoin(directory, '.lock'), shared=True):
+                open(pjoin(version, 'pids', str(os.getpid())), 'w').close()
+                os.utime(pjoin(version, 'size'))
+        except OSError:
+            return False
+        LOG.debug('stage: using %s for %s', dest, path)
+        return True
+    if use():
+        return dest
+    try:
+        private_dir(env_dir)
+    except OSError as e:
+        LOG.warning('stage: can not use %s (%s), using %s directly', env_dir, e, path)
+        return path
+    with locked(env_dir+'.lock'):
+        if use():
+            return dest
+        old = [v for v in staged_versions(directory) if os.path.dirname(v[2]) == env_dir]
+        reuse = pjoin(old[-1][2], os.path.basename(dest)) if old else None
+        LOG.info('stage: copying %s to %s%s', path, dest, ' (updating)' if reuse else '')
+        tmp = tempfile.mkdtemp(dir=env_dir, prefix='.tmp-')
+        try:
+            size = stage_tree(path, pjoin(tmp, os.path.basename(dest)), method='copy',
+                              max_size=max_size*2**20, reuse=reuse)
+            os.mkdir(pjoin(tmp, 'pids'))
+            # In use from the start, so that it isn't evicted before use().
+            open(pjoin(tmp, 'pids', str(os.getpid())), 'w').close()
+            with open(pjoin(tmp, 'size'), 'w') as f:
+                f.write(str(size))
+            os.rename(tmp, version)
+        except (OSError, RuntimeError) as e:
+            LOG.warning('stage: could not copy %s (%s), using it directly', path, e)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return path
+        use()
+    # Remove the replaced versions, and evict least recently used
+    # first.  Which versions are in use is only known while holding
+    # the lock.
+    with locked(pjoin(directory, '.lock')):
+        versions = staged_versions(directory)
+        total = sum(v[1] for v in versions)
+        for _, size, old_version, users in versions:
+            if old_version == version or users:
+                continue
+            if os.path.dirname(old_version) == env_dir or total > max_size * 2**20:
+                LOG.debug('stage: removing %s', old_version)
+                shutil.rmtree(old_version, ignore_errors=True)
+                total -= size
+    return dest
+
+
+# Launch journal.  Each kernel start appends one line with the time
+# spent in each phase of the run mode.  It is plain text, so that
+# writing it needs no imports, and rotated when it reaches
+# JOURNAL_MAX_SIZE (one old file, .1, is kept).
+JOURNAL_MAX_SIZE = 2**20  # bytes
+
+
+def journal_file():
+    """Path of the launch journal, or None if disabled.
+
+    $ENVKERNEL_JOURNAL overrides the default location in the cache
+    directory, and disables the journal if it is empty or `off`.  Also
+    None if the cache directory can't be used: the journal must never
+    stop a kernel from starting."""
+    path = os.environ.get('ENVKERNEL_JOURNAL')
+    if path is None:
+        try:
+            return pjoin(cache_dir(), 'launches.log')
+        except OSError as e:
+            LOG.debug('journal: can not use cache dir: %s', e)
+            return None
+    if path in ('', 'off'):
+        return None
+    return path
+
+
+def journal_write(fields, phases, path=None):
+    """Append one launch record: tab-separated fields, then phase=ms items"""
+    import time
+    path = path or journal_file()
+    if path is None:
+        return
+    clean = lambda x: str(x).replace('\t', ' ').replace('\n', ' ')
+    line = '\t'.join([str(int(time.time()))] + [clean(x) for x in fields]
+                     + ['%s=%.1f'%(name, ms) for name, ms in phases]) + '\n'
+    def open_():
+        return os.open(path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o600)
+    try:
+        fd = open_()
+        try:
+            st = os.fstat(fd)
+            if st.st_size + len(line) > JOURNAL_MAX_SIZE:
+                # Rotate, unless another start just did, and write to
+                # the new file.
+                try:
+                    if os.path.samestat(os.stat(path), st):
+                        os.replace(path, path+'.1')
+                except FileNotFoundError:
+                    pass  # Being rotated by another start
+                new = open_()
+                os.close(fd)
+                fd = new
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except OSError as e:
+        LOG.debug('journal: can not write %s: %s', path, e)
+
+
+def journal_read(path):
+    """Yield records (dicts) from the launch journal and its rotated file"""
+    for fname in (path+'.1', path):
+        try:
+            lines = open(fname).read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            parts = line.split('\t')
+            if len(parts) < 4:
+                continue
+            record = {'time': int(parts[0]), 'mode': parts[1], 'kernel': parts[2],
+                      'target': parts[3], 'phases': { }}
+            for item in parts[4:]:
+                name, _, ms = item.partition('=')
+                try:
+                    record['phases'][name] = float(ms)
+                except ValueError:
+                    pass
+            yield record
+
+
+def percentiles(values):
+    """(p50, p95, max) of a list of numbers"""
+    values = sorted(values)
+    p = lambda q: values[min(len(values)-1, int(round(q*(len(values)-1))))]
+    return p(.5), p(.95), values[-1]
+
+
+# Launch plans.  For modes whose environment changes are known at
+# setup time, setup writes them into a plan file in the kernel
+# directory, and the run mode only applies them, without parsing its
+# arguments again.  The format is plain text, one tab-separated item
+# per line, so that reading it needs no imports:
+#
+#   envkernel-plan<TAB>VERSION
+#   mode<TAB>MODE
+#   target<TAB>PATH
+#   OP<TAB>NAME[<TAB>VALUE]      (edits, see apply_edits)
+#
+# A plan with another version is ignored (the arguments are used).
+PLAN_VERSION = '1'
+PLAN_EDITS = {'set': 2, 'unset': 1, 'prepend': 2, 'prefix': 2,
+              'dedup': 1, 'prune': 1, 'lib-cache': 1, 'cache-dir': 2}
+
+
+def apply_edits(edits, environ=None):
+    """Apply environment edits [(op, name, [value])] to environ.
+
+    set: set to value; unset: remove; prepend: prepend value to a
+    PATH-like variable; prefix: prepend value to the string, if set;
+    dedup: remove repeated directories from a PATH-like variable;
+    prune: also remove nonexistent directories;
+    lib-cache: replace a library path with its lib_cache();
+    cache-dir: set to the envkernel cache subdirectory value (created)."""
+    if environ is None:
+        environ = os.environ
+    for op, name, *value in edits:
+        if op == 'set':
+            environ[name] = value[0]
+        elif op == 'unset':
+            environ.pop(name, None)
+        elif op == 'prepend':
+            environ[name] = path_join(value[0], environ.get(name, None))
+        elif op == 'prefix':
+            if name in environ:
+                environ[name] = value[0] + environ[name]
+        elif op in ('dedup', 'prune'):
+            if name in environ:
+                environ[name] = clean_path(environ[name], prune=(op == 'prune'))
+        elif op == 'lib-cache':
+            if environ.get(name):
+                environ[name] = lib_cache(environ[name]) or environ[name]
+        elif op == 'cache-dir':
+            try:
+                environ[name] = cache_dir(value[0])
+            except OSError as e:
+                LOG.warning('can not use cache dir for %s (%s)', name, e)
+        else:
+            raise ValueError("Unknown environment edit: %s"%op)
+
+
+def format_plan(mode, target, edits):
+    """Text of a launch plan, or None if it can't be written"""
+    items = [('envkernel-plan', PLAN_VERSION), ('mode', mode), ('target', target), *edits]
+    if any('\t' in x or '\n' in x for item in items for x in item):
+        return None
+    return ''.join('\t'.join(item)+'\n' for item in items)
+
+
+def read_plan(path):
+    """Read a launch plan, return (mode, target, edits) or None if unusable"""
+    try:
+        lines = open(path).read().splitlines()
+    except OSError as e:
+        LOG.info('plan: can not read %s (%s)', path, e)
+        return None
+    items = [line.split('\t') for line in lines]
+    if not items or items[0] != ['envkernel-plan', PLAN_VERSION]:
+        LOG.info('plan: %s is not a version %s plan', path, PLAN_VERSION)
+        return None
+    header = dict(x for x in items[1:3] if len(x) == 2)
+    edits = items[3:]
+    if (set(header) != {'mode', 'target'}
+            or any(PLAN_EDITS.get(x[0]) != len(x)-1 for x in edits)):
+        LOG.info('plan: %s is invalid', path)
+        return None
+    return header['mode'], header['target'], edits
+
+
+# Program for `python -c` which runs envkernel from a given directory
+ISOLATED_MAIN = 'import sys; sys.path.insert(0, %r); from envkernel import main; sys.exit(main())'
+
+# Program for `python -c`, run with the environment's Python by setup
+# --compile: import the given modules (so that the kernel's imports are
+# compiled), then compile everything in site-packages.
+COMPILE_PROGRAM = """\
+import compileall, importlib, sys, sysconfig
+for name in sys.argv[1:]:
+    try:
+        importlib.import_module(name)
+    except Exception as e:
+        print('could not import %s: %s' % (name, e), file=sys.stderr)
+files = {getattr(m, '__file__', None) for m in list(sys.modules.values())}
+for f in sorted(x for x in files if x and x.endswith('.py')):
+    compileall.compile_file(f, quiet=2)
+for d in sorted({sysconfig.get_paths()[x] for x in ('purelib', 'platlib')}):
+    compileall.compile_dir(d, quiet=2, workers=0)
+"""
+
+
+
+def get_umask():
+    """The umask of this process.
+
+    os.umask() can only read the umask by setting it, which races with
+    other threads, so on Linux it is read from /proc instead."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    umask = os.umask(0)
+    os.umask(umask)  # Restore previous, this is just how it works...
+    return umask
+
+
+# Files found by resource lookups, shared by all kernels set up in this
+# process (install-manifest sets up many).
+_resource_cache = { }
+
+def ipykernel_resources():
+    """{fname: path} of the logos shipped with ipykernel"""
+    if 'ipykernel' not in _resource_cache:
+        import glob
+        try:
+            import ipykernel
+            ipykernel_dir = os.path.dirname(ipykernel.__file__)
+            logos = glob.glob(pjoin(ipykernel_dir, 'resources', '*'))
+            _resource_cache['ipykernel'] = {os.path.basename(x): x for x in logos}
+        except ImportError:
+            LOG.debug("Could not automatically find ipykernel logos")
+            _resource_cache['ipykernel'] = { }
+    return _resource_cache['ipykernel']
+
+
+
 class envkernel():
     execvp = staticmethod(os.execvp)
-    def __init__(self, argv):
+    # The modules, path or image of this kernel, for the launch journal
+    journal_target = ''
+    # Environment variable with the kernel's name (set in kernel.json)
+    NAME_ENV = 'ENVKERNEL_NAME'
+    # Environment variable which enables running stacked layers in one process
+    CHAIN_ENV = 'ENVKERNEL_CHAIN'
+    # The layers which ran before this one in this process (with --chain)
+    outer_layers = ()
+    # Setup options which change process-wide state (os.environ), so
+    # that install-manifest must not set up such kernels in parallel.
+    serial_setup_options = ()
+    # Set by install-manifest, which checks all kernels at the end.
+    verify_install = True
+    # Whether --verbose sets the (process-wide) log level.  Unset by
+    # install-manifest, where kernels are set up in parallel threads.
+    set_log_level = True
+    def __init__(self, argv, ksm=None):
+        import time
         LOG.debug('envkernel: cli args: %s', argv)
         self.argv = argv
+        self._ksm = ksm
+        self.phases = [('start', time.perf_counter())]
     def setup(self):
+        import argparse
+        import copy
+        import json
         parser = argparse.ArgumentParser()
         parser.add_argument('--name', required=True,
                                   help="Kernel name to install as")
@@ -110,6 +1116,15 @@ class envkernel():
                             help="Install kernel to this prefix")
         parser.add_argument('--replace', action='store_true',
                             help="Replace existing kernel")
+        parser.add_argument('--if-changed', action='store_true',
+                            help="Don't touch the installed kernel if it is the same, and "
+                                 "replace it atomically (where supported) if not.")
+        parser.add_argument('--link-resources', choices=['hardlink', 'symlink'],
+                            help="Store resource files (logos, template files) once in a shared "
+                                 "directory and link them into the kernel, instead of copying.")
+        parser.add_argument('--resource-store',
+                            help="Directory for --link-resources (default .envkernel-resources "
+                                 "beside the installed kernel)")
         parser.add_argument('--kernel',
                             help="Kernel to install, options are ipykernel or ir (default ipykernel).  This "
                                  "simply sets the --kernel-cmd and --language options to the proper "
@@ -128,11 +1143,18 @@ class envkernel():
         parser.add_argument('--env', action='append', default=[],
                             help="Environment to add, format NAME=VAL.  Can be given multiple times. "
                                  "These are statically embedded in the kernel.json file")
+        parser.add_argument('--isolate', action='store_true',
+                            help="When the kernel starts, run envkernel with 'python -I -S'.  This "
+                                 "skips site-packages and PYTHON* variables for envkernel itself "
+                                 "(not the kernel), so it starts faster.")
+        parser.add_argument('--chain', action='store_true',
+                            help="If the kernel command is another envkernel kernel (with "
+                                 "--kernel-template), run all the layers in one process.")
         parser.add_argument('--verbose', '-v', action='store_true',
                                   help="Print more debugging information")
         args, unknown_args = parser.parse_known_args(self.argv)
-        if args.verbose:
-            LOG.setLevel(logging.DEBUG)
+        if args.verbose and self.set_log_level:
+            LOG.setLevel(DEBUG)
 
         LOG.debug('setup: envkernel setup args: %s', args)
         LOG.debug('setup: kernel-specific args: %s', unknown_args)
@@ -145,6 +1167,7 @@ class envkernel():
             self.prefix = args.prefix
         self.replace = args.replace
         self.copy_files = { }
+        self.write_files = { }
 
         # Setting the kernel.  Go through least-specific to
         # most-specific, updating self.kernel with the latest (most
@@ -155,8 +1178,7 @@ class envkernel():
         # Existing kernel as a template.
         self.kernel = { }
         if args.kernel_template:
-            import jupyter_client.kernelspec
-            template = jupyter_client.kernelspec.KernelSpecManager().get_kernel_spec(args.kernel_template)
+            template = self.kernel_spec_manager().get_kernel_spec(args.kernel_template)
             template_dir = template.resource_dir
             self.copy_files.update({x: pjoin(template_dir, x) for x in os.listdir(template_dir)})
             self.kernel = json.loads(template.to_json())
@@ -187,27 +1209,58 @@ class envkernel():
         # Copy logos from upstream packages, if exists
         self.logos = None
         if self.kernel['language'] == 'python':
-            try:
-                import ipykernel
-                ipykernel_dir = os.path.dirname(ipykernel.__file__)
-                logos = glob.glob(pjoin(ipykernel_dir, 'resources', '*'))
-                for fullpath in logos:
-                    fname = os.path.basename(fullpath)
-                    if fname not in self.copy_files:
-                        self.copy_files[fname] = fullpath
-            except ImportError:
-                LOG.debug("Could not automatically find ipykernel logos")
+            for fname, fullpath in ipykernel_resources().items():
+                if fname not in self.copy_files:
+                    self.copy_files[fname] = fullpath
         # env
         for env in args.env:
             name, value = env.split('=', 1)
             self.kernel.setdefault('env', {})[name] = value
+        # For the launch journal
+        self.kernel.setdefault('env', {})[self.NAME_ENV] = self.name
+        if args.chain:
+            self.kernel['env'][self.CHAIN_ENV] = '1'
         #
         self.argv = unknown_args
 
     def _get_parser(self):
         pass
 
+    def envkernel_argv(self):
+        """The command which re-runs envkernel, to start the kernel argv."""
+        if self.setup_args.isolate:
+            # The run mode only needs this one file and the standard
+            # library, so this is safe.  It is imported instead of run
+            # as a script so that the cached bytecode is used.
+            return [sys.executable, '-I', '-S', '-c', ISOLATED_MAIN%os.path.dirname(os.path.realpath(__file__))]
+        return [os.path.realpath(sys.argv[0])]
+
+    @staticmethod
+    def add_path_options(parser):
+        """Run options for cleaning the search paths after the environment is set"""
+        parser.add_argument('--prune-paths', action='store_true',
+                            help="Remove directories which don't exist from PATH-like variables")
+        parser.add_argument('--lib-cache', action='store_true',
+                            help="Replace LD_LIBRARY_PATH with a cached directory of links "
+                                 "to its libraries")
+
+    @staticmethod
+    def path_cleanup_edits(prune_paths=False, lib_cache=False):
+        """Environment edits (see apply_edits) for the add_path_options options"""
+        edits = [('prune', name) for name in PATH_VARS] if prune_paths else [ ]
+        if lib_cache:
+            edits.append(('lib-cache', 'LD_LIBRARY_PATH'))
+        return edits
+
+    def kernel_spec_manager(self):
+        """The KernelSpecManager to use (creating one scans the Jupyter paths)"""
+        if self._ksm is None:
+            import jupyter_client.kernelspec
+            self._ksm = jupyter_client.kernelspec.KernelSpecManager()
+        return self._ksm
+
     def get_kernel(self):
+        import copy
         return copy.deepcopy(self.kernel)
 
     def install_kernel(self, kernel, name, user=False, replace=None, prefix=None, logos=None):
@@ -218,6 +1271,7 @@ class envkernel():
         kernel: kernel JSON
         name: kernel name
         """
+        import tempfile
         import jupyter_client.kernelspec
         #jupyter_client.kernelspec.KernelSpecManager().get_kernel_spec('python3').argv
 
@@ -225,56 +1279,555 @@ class envkernel():
         if jupyter_client.version_info >= (4, 0, 0):
             replace = None
 
-        with tempfile.TemporaryDirectory(prefix='jupyter-kernel-secure-') \
-          as kernel_dir:
-            # Apply umask
-            umask = os.umask(0)
-            os.umask(umask)  # Restore previous, this is just how it works...
-            os.chmod(kernel_dir, 0o777& (~umask))
-            # Copy files from template.  This also copies kernel.json,
-            # but we will overwrite that next.
-            for fname, fullpath in self.copy_files.items():
-                shutil.copy(fullpath, pjoin(kernel_dir, fname))
-            # Write kernel.json
-            open(pjoin(kernel_dir, 'kernel.json'), 'w').write(
-                json.dumps(kernel, sort_keys=True, indent=1))
-            jupyter_client.kernelspec.KernelSpecManager().install_kernel_spec(
-                kernel_dir, kernel_name=name,
-                user=user, replace=replace, prefix=prefix)
+        if self.setup_args.if_changed:
+            self._install_if_changed(kernel, name, user=user, prefix=prefix)
+        else:
+            with tempfile.TemporaryDirectory(prefix='jupyter-kernel-secure-') \
+              as kernel_dir:
+                self._write_kernel_dir(kernel_dir, kernel)
+                self.kernel_dir = self.kernel_spec_manager().install_kernel_spec(
+                    kernel_dir, kernel_name=name,
+                    user=user, replace=replace, prefix=prefix)
+        if self.setup_args.link_resources:
+            self._link_resources(self.kernel_dir)
 
         LOG.info("")
         LOG.info("  Kernel command: %s", kernel['argv'])
+        if not self.verify_install:
+            return
         try:
-            LOG.info("  Success: Kernel saved to {}".format(jupyter_client.kernelspec.KernelSpecManager().get_kernel_spec(name).resource_dir))
+            LOG.info("  Success: Kernel saved to {}".format(self.kernel_spec_manager().get_kernel_spec(name).resource_dir))
         except jupyter_client.kernelspec.NoSuchKernel:
             LOG.info("  Note: Kernel not detected with current search path.")
         #LOG.info("  Kernel file:\n%s", textwrap.indent(json.dumps(kernel, sort_keys=True, indent=1), '    '))
 
+    def _write_kernel_dir(self, kernel_dir, kernel):
+        """Write all files of the kernel into kernel_dir"""
+        import json
+        import shutil
+        # Apply umask
+        umask = get_umask()
+        os.chmod(kernel_dir, 0o777& (~umask))
+        # Copy files from template.  This also copies kernel.json,
+        # but we will overwrite that next.
+        for fname, fullpath in self.copy_files.items():
+            shutil.copy(fullpath, pjoin(kernel_dir, fname))
+        # Write files generated by the mode
+        for fname, data in self.write_files.items():
+            open(pjoin(kernel_dir, fname), 'w').write(data)
+        # Write kernel.json
+        open(pjoin(kernel_dir, 'kernel.json'), 'w').write(
+            json.dumps(kernel, sort_keys=True, indent=1))
+
+    def kernel_files(self, kernel):
+        """{fname: bytes} of all files which would be installed for kernel"""
+        import json
+        contents = { }
+        for fname, fullpath in self.copy_files.items():
+            contents[fname] = open(fullpath, 'rb').read()
+        for fname, data in self.write_files.items():
+            contents[fname] = data.encode()
+        contents['kernel.json'] = json.dumps(kernel, sort_keys=True, indent=1).encode()
+        return contents
+
+    @staticmethod
+    def installed_files(kernel_dir):
+        """{fname: bytes} of the files installed in kernel_dir, None if there is none"""
+        try:
+            return {fname: open(pjoin(kernel_dir, fname), 'rb').read()
+                    for fname in os.listdir(kernel_dir)}
+        except OSError:
+            return None
+
+    @staticmethod
+    def content_hash(contents):
+        """Hash of {fname: bytes}"""
+        import hashlib
+        h = hashlib.sha256()
+        for fname in sorted(contents):
+            h.update(fname.encode() + b'\0' + hashlib.sha256(contents[fname]).digest())
+        return h.hexdigest()
+
+    def kernel_destination(self, name, user=False, prefix=None):
+        """Directory install_kernel_spec would install kernel name to
+
+        Checks the name and options like install_kernel_spec does, and
+        raises ValueError if they are not valid."""
+        import re
+        from jupyter_core.paths import SYSTEM_JUPYTER_PATH
+        try:
+            from jupyter_client.kernelspec import _is_valid_kernel_name
+        except ImportError:
+            def _is_valid_kernel_name(name):
+                return re.match(r'^[a-z0-9._\-]+$', name, re.IGNORECASE)
+        if not _is_valid_kernel_name(name):
+            raise ValueError("Invalid kernel name %r.  Kernel names can only contain ASCII "
+                             "letters and numbers and these separators: - . _"%name)
+        if user and prefix:
+            raise ValueError("Can't specify both user and prefix. Please choose one or the other.")
+        if user:
+            kernels = self.kernel_spec_manager().user_kernel_dir
+        elif prefix:
+            kernels = pjoin(os.path.abspath(prefix), 'share', 'jupyter', 'kernels')
+        else:
+            kernels = pjoin(SYSTEM_JUPYTER_PATH[0], 'kernels')
+        return pjoin(kernels, name)
+
+    def _install_if_changed(self, kernel, name, user=False, prefix=None):
+        """Install the kernel, unless the same is already installed.
+
+        What is installed is compared file by file, so a kernel which
+        was changed by hand is also replaced.  The new kernel is
+        written beside the old one and swapped in with one atomic
+        rename (rename_exchange).  Where that isn't supported, two
+        renames are used: readers never see a partly written kernel,
+        but for an instant between them, no kernel at all."""
+        import shutil
+        import tempfile
+        name = name.lower()
+        destination = self.kernel_destination(name, user=user, prefix=prefix)
+        self.kernel_dir = destination
+        contents = self.kernel_files(kernel)
+        installed = self.installed_files(destination)
+        if installed is not None and self.content_hash(installed) == self.content_hash(contents):
+            LOG.info("  Unchanged: %s", destination)
+            return False
+        parent = os.path.dirname(destination)
+        os.makedirs(parent, exist_ok=True)
+        # Temporary names are hidden, so not seen as kernels.
+        new = tempfile.mkdtemp(dir=parent, prefix='.%s-new-'%name)
+        try:
+            self._write_kernel_dir(new, kernel)
+            if not os.path.isdir(destination):
+                os.rename(new, destination)
+            elif rename_exchange(new, destination):
+                shutil.rmtree(new)  # now the old kernel
+            else:
+                old = tempfile.mkdtemp(dir=parent, prefix='.%s-old-'%name)
+                os.rename(destination, old)  # replaces the empty directory
+                os.rename(new, destination)
+                shutil.rmtree(old)
+        except BaseException:
+            shutil.rmtree(new, ignore_errors=True)
+            raise
+        LOG.info("  Installed: %s", destination)
+        return True
+
+    def _link_resources(self, kernel_dir):
+        """Replace copied resource files in kernel_dir with links to a shared store.
+
+        Store entries are named by the hash of their content, so every
+        kernel with the same logo links to the same file.  Files which
+        can't be linked (other filesystem, no permission) stay copies."""
+        import hashlib
+        import tempfile
+        args = self.setup_args
+        store = args.resource_store or pjoin(os.path.dirname(kernel_dir), '.envkernel-resources')
+        try:
+            os.makedirs(store, exist_ok=True)
+        except OSError as e:
+            LOG.info("  Can not create resource store %s (%s), copying resources", store, e)
+            return
+        for fname in self.copy_files:
+            if fname == 'kernel.json' or fname in self.write_files:
+                continue
+            path = pjoin(kernel_dir, fname)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            data = open(path, 'rb').read()
+            stored = pjoin(store, hashlib.sha256(data).hexdigest() + os.path.splitext(fname)[1])
+            tmp = pjoin(kernel_dir, '.tmp-'+fname)
+            try:
+                if not os.path.exists(stored):
+                    fd, new = tempfile.mkstemp(dir=store, prefix='.tmp-')
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.chmod(new, 0o666 & ~get_umask())
+                    os.replace(new, stored)
+                if args.link_resources == 'hardlink':
+                    if os.path.samefile(path, stored):
+                        continue
+                    os.link(stored, tmp)
+                else:
+                    os.symlink(os.path.relpath(stored, kernel_dir), tmp)
+                os.replace(tmp, path)
+            except OSError as e:
+                LOG.debug("  Can not link %s to %s (%s), keeping a copy", fname, stored, e)
+                if os.path.lexists(tmp):
+                    os.unlink(tmp)
+
+    def cleanup_after_exit(self, paths):
+        """Remove paths after the kernel (which replaces this process) exits"""
+        run_detached(remove_after_exit, os.getpid(), paths)
+
     def run(self):
         """Hook that gets run before kernel invoked"""
         # User does not directly see this (except interleaved in
         # normal jupyter logging output), so we can set it to debug
         # by default.
-        LOG.setLevel(logging.DEBUG)
+        LOG.setLevel(DEBUG)
+
+    def mark(self, phase, target=None):
+        """Record that a phase of the run mode ended now"""
+        import time
+        self.phases.append((phase, time.perf_counter()))
+        if target is not None:
+            self.journal_target = target
+
+    def phase_times(self):
+        """[(phase, milliseconds)] of the phases so far, and the total"""
+        times = [(name, (t - self.phases[i][1])*1000)
+                 for i, (name, t) in enumerate(self.phases[1:])]
+        return times + [('total', (self.phases[-1][1] - self.phases[0][1])*1000)]
+
+    # Launch plans are named envkernel-plan-HASH in the kernel
+    # directory.  The hash keeps the plan of a --kernel-template
+    # kernel, which is copied along, apart from this kernel's plan.
+    plan_prefix = 'envkernel-plan-'
+
+    def run_plan(self):
+        """Run the kernel using a launch plan (--plan=FILE as the first argument).
+
+        Returns False, without changing anything, if there is no usable
+        plan; the normal run() should then be used."""
+        if not self.argv or not self.argv[0].startswith('--plan='):
+            return False
+        plan = read_plan(self.argv[0][len('--plan='):])
+        argv, rest = split_doubledash(self.argv, 1)
+        if plan is None or (plan[0], plan[1]) != (self.__class__.__name__, argv[-1]):
+            return False
+        LOG.setLevel(DEBUG)
+        mode, target, edits = plan
+        self.mark('parse', target=target)
+        LOG.debug('plan: %s %s: %s', mode, target, edits)
+        apply_edits(edits)
+        self.exec_kernel(rest)
+        return True
+
+    def exec_kernel(self, cmd):
+        """Replace this process with the kernel command (the end of run mode)"""
+        self.mark('prepare')
+        layers = [*self.outer_layers, self]
+        LOG.debug('layer %d (%s): %s', len(layers), self.__class__.__name__,
+                  ', '.join('%s %.1f ms'%x for x in self.phase_times()))
+        inner = self._inner_layer(cmd)
+        if inner is not None:
+            # The kernel command is another envkernel run mode: do it
+            # here, instead of starting a new interpreter for it.
+            mode, argv = inner
+            ek = globals()[mode](argv)
+            ek.outer_layers = layers
+            ek.execvp = self.execvp
+            if ek.run_plan():
+                return 0
+            return ek.run()
+        phases = { }
+        for layer in layers:
+            for name, ms in layer.phase_times()[:-1]:
+                phases[name] = phases.get(name, 0) + ms
+        phases['total'] = (self.phases[-1][1] - layers[0].phases[0][1]) * 1000
+        journal_write(['+'.join(x.__class__.__name__ for x in layers),
+                       os.environ.get(self.NAME_ENV, ''),
+                       ' + '.join(x.journal_target for x in layers)], list(phases.items()))
+        return self.execvp(cmd[0], cmd)
+
+    def _inner_layer(self, cmd):
+        """(mode, run argv) if cmd runs this same envkernel in run mode, and --chain is on"""
+        if os.environ.get(self.CHAIN_ENV) != '1':
+            return None
+        here = os.path.dirname(os.path.realpath(__file__))
+        if cmd[1:5] == ['-I', '-S', '-c', ISOLATED_MAIN%here]:
+            rest = cmd[5:]
+        elif os.path.realpath(cmd[0]) in (os.path.realpath(sys.argv[0]), os.path.realpath(__file__)):
+            rest = cmd[1:]
+        else:
+            return None
+        if len(rest) < 2 or rest[1] != 'run' or not mode_known(rest[0]):
+            return None
+        return rest[0], rest[2:]
+
+
+
+def lmod_spider_cache_paths(environ=None):
+    """Spider cache dirs and timestamp files listed in Lmod's lmodrc.lua
+
+    Lmod updates these when the system module tree changes, so their
+    mtimes are a cheap way to detect changes."""
+    if environ is None:
+        environ = os.environ
+    rcfiles = [x for x in environ.get('LMOD_RC', '').split(':') if x]
+    if environ.get('LMOD_CONFIG_DIR'):
+        rcfiles.append(pjoin(environ['LMOD_CONFIG_DIR'], 'lmodrc.lua'))
+    if environ.get('LMOD_PKG'):
+        rcfiles.append(pjoin(environ['LMOD_PKG'], 'init', 'lmodrc.lua'))
+    rcfiles.append('/etc/lmod/lmodrc.lua')
+    import re
+    paths = [ ]
+    for rcfile in rcfiles:
+        try:
+            data = open(rcfile).read()
+        except OSError:
+            continue
+        paths.extend(re.findall(r'(?:dir|timestamp)\s*=\s*["\']([^"\']+)["\']', data))
+    return paths
+
+
+def lmod_fingerprint(environ=None):
+    """Data which changes when the available modules change"""
+    if environ is None:
+        environ = os.environ
+    modulepath = [x for x in environ.get('MODULEPATH', '').split(':') if x]
+    return mtimes(modulepath + lmod_spider_cache_paths(environ))
+
+
+_module_index = { }
+
+def version_key(version):
+    """Sort key for versions, so that 3.10 comes after 3.9"""
+    import re
+    return [(1, int(x), '') if x.isdigit() else (0, 0, x)
+            for x in re.split(r'(\d+)', version) if x]
+
+def _lmod_spider(environ):
+    """Module index from `spider -o jsonSoftwarePage`, or None"""
+    import json
+    import subprocess
+    spider = pjoin(environ.get('LMOD_PKG', ''), 'libexec', 'spider')
+    if not environ.get('LMOD_PKG') or not os.access(spider, os.X_OK):
+        return None
+    try:
+        out = subprocess.run([spider, '-o', 'jsonSoftwarePage', environ.get('MODULEPATH', '')],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             env=environ, check=True).stdout
+        packages = json.loads(out.decode())
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        LOG.debug('Lmod: spider failed (%s), scanning MODULEPATH', e)
+        return None
+    modules, defaults = set(), { }
+    for package in packages:
+        versions = [v for v in package.get('versions', []) if v.get('full')]
+        if not versions:
+            continue
+        modules.update(v['full'] for v in versions)
+        marked = [v['full'] for v in versions if v.get('markedDefault')]
+        name = package.get('package') or os.path.dirname(versions[0]['full'])
+        defaults[name] = marked[0] if marked else max((v['full'] for v in versions), key=version_key)
+    return modules, defaults
+
+def _lmod_scan(modulepath):
+    """Module index from the files in the MODULEPATH directories"""
+    import re
+    modules, defaults = set(), { }
+    for root in modulepath:
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+            package = os.path.relpath(dirpath, root)
+            found = [ ]
+            for fname in filenames:
+                if fname.startswith('.') or fname == 'default':
+                    continue
+                if fname.endswith('.lua'):
+                    fname = fname[:-4]
+                else:
+                    try:
+                        with open(pjoin(dirpath, fname), 'rb') as f:
+                            if not f.read(8).startswith(b'#%Module'):
+                                continue
+                    except OSError:
+                        continue
+                found.append(fname if package == '.' else package+'/'+fname)
+            modules.update(found)
+            if package == '.' or not found or package in defaults:
+                continue
+            default = None
+            if os.path.islink(pjoin(dirpath, 'default')):
+                default = package+'/'+os.path.basename(os.readlink(pjoin(dirpath, 'default')))
+                default = default[:-4] if default.endswith('.lua') else default
+            try:
+                m = re.search(r'ModulesVersion\s+"?([^"\s]+)', open(pjoin(dirpath, '.version')).read())
+                if m:
+                    default = package+'/'+m.group(1)
+            except OSError:
+                pass
+            defaults[package] = default if default in found else max(found, key=version_key)
+    return modules, defaults
+
+def lmod_module_index(environ=None):
+    """(set of full module names, {package: default full name})
+
+    From Lmod's spider if it can be run, otherwise by scanning
+    MODULEPATH.  This is done once per process (and MODULEPATH), so
+    that installing many kernels doesn't run spider for each."""
+    if environ is None:
+        environ = os.environ
+    key = (environ.get('LMOD_PKG'), environ.get('MODULEPATH'))
+    if key not in _module_index:
+        index = _lmod_spider(environ)
+        if index is None:
+            index = _lmod_scan([x for x in environ.get('MODULEPATH', '').split(':') if x])
+        _module_index[key] = index
+    return _module_index[key]
+
+def lmod_resolve(modules, environ=None):
+    """Return {module: full module name} for modules to be loaded.
+
+    Names without a version resolve to the default version.  Unloads
+    (`-name`) are not checked.  Raises RuntimeError for unknown modules."""
+    import difflib
+    available, defaults = lmod_module_index(environ)
+    resolved = { }
+    for module in modules:
+        if module.startswith('-'):
+            continue
+        if module in available:
+            resolved[module] = module
+        elif module in defaults:
+            resolved[module] = defaults[module]
+        else:
+            close = difflib.get_close_matches(module, [*available, *defaults], n=3)
+            raise RuntimeError("Unknown module %s%s"%(module,
+                               " (did you mean: %s?)"%', '.join(close) if close else ''))
+    return resolved
 
 
 
 class lmod(envkernel):
+    # Named by a hash of the content, like launch plans, so that a
+    # frozen layer of a --kernel-template kernel is kept apart.
+    frozen_prefix = 'envkernel-lmod-frozen-'
+    serial_setup_options = ('--freeze', )
+
     def setup(self):
+        import argparse
+        import json
         super().setup()
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--freeze', action='store_true',
+                            help="Load the modules now and store the resulting environment "
+                                 "in the kernel, instead of loading them at each start.")
+        parser.add_argument('--validate', action='store_true',
+                            help="Check that the modules exist")
+        parser.add_argument('--pin', action='store_true',
+                            help="Check the modules and store them with their full versions")
+        args, unknown_args = parser.parse_known_args(self.argv)
+        LOG.debug('setup: args: %s', args)
+
+        run_argv = list(unknown_args)
+        if args.validate or args.pin:
+            run_args, _ = self._run_parser().parse_known_args(unknown_args)
+            try:
+                resolved = lmod_resolve(run_args.module)
+            except RuntimeError as e:
+                LOG.critical("ERROR: %s", e)
+                sys.exit(1)
+            if args.pin:
+                LOG.debug('Lmod: pinned modules: %s', resolved)
+                modules = set(run_args.module)
+                run_argv = [resolved.get(x, x) if x in modules else x for x in run_argv]
+        if args.freeze:
+            if 'LMOD_PKG' not in os.environ:
+                LOG.critical("ERROR: --freeze loads the modules now, but Lmod is not "
+                             "available (LMOD_PKG is not set)")
+                sys.exit(1)
+            run_args, _ = self._run_parser().parse_known_args(run_argv)
+            before = dict(os.environ)
+            try:
+                delta = self._load(run_args.purge, run_args.module)
+            finally:
+                os.environ.clear()
+                os.environ.update(before)
+            # The delta has whole values (PATH etc.) computed from our
+            # environment, so store what they were before loading: the
+            # delta only applies to a kernel started with the same ones.
+            frozen = json.dumps({
+                'version': 2,
+                'purge': run_args.purge,
+                'modules': run_args.module,
+                'fingerprint': lmod_fingerprint(),
+                'base': {name: before.get(name) for name in delta},
+                'delta': delta,
+                }, sort_keys=True, indent=1)
+            frozen_file = self.frozen_prefix + cache_key(frozen)[:12] + '.json'
+            self.write_files[frozen_file] = frozen
+            run_argv.insert(0, '--frozen={resource_dir}/'+frozen_file)
+
         kernel = self.get_kernel()
         kernel['argv'] = [
-            os.path.realpath(sys.argv[0]),
+            *self.envkernel_argv(),
             self.__class__.__name__, 'run',
-            *self.argv,
+            *run_argv,
             '--',
             *kernel['argv'],
         ]
         if 'display_name' not in kernel:
-            kernel['display_name'] = "{}".format(' '.join(self.argv))
+            kernel['display_name'] = "{}".format(' '.join(unknown_args))
         self.install_kernel(kernel, name=self.name, user=self.user,
                             replace=self.replace, prefix=self.prefix)
 
+    def _run_parser(self):
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--purge', action='store_true', default=False, help="Purge existing modules first")
+        parser.add_argument('--cache', action='store_true',
+                            help="Cache the environment resulting from the module load")
+        parser.add_argument('--cache-dir',
+                            help="Cache directory (default ~/.cache/envkernel)")
+        parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE,
+                            help="Maximum size of the cache directory in MB")
+        parser.add_argument('--frozen', help="Environment stored at setup time (internal use)")
+        self.add_path_options(parser)
+        parser.add_argument('module', nargs='+')
+        return parser
+
+    @staticmethod
+    def _module(command, *arguments):
+        """Copy of the lmod command above, but works on python2&3
+
+        ... to work around old lmod installations that don't have
+        python3 support.
+        """
+        commands = os.popen(
+            '%s/libexec/lmod python %s %s'\
+            % (os.environ['LMOD_PKG'], command, ' '.join(arguments))).read()
+        exec(commands)
+
+    def _load(self, purge, modules):
+        """Load modules into os.environ, return the environment delta"""
+        before = dict(os.environ)
+        if purge:
+            LOG.debug('Lmod purging')
+            self._module('purge')
+        LOG.debug('Lmod loading ' + ' '.join(modules))
+        self._module('load', *modules)
+        return env_delta(before, os.environ)
+
+    def _load_frozen(self, args):
+        """Apply the environment stored by setup --freeze, if still valid."""
+        import json
+        try:
+            frozen = json.load(open(args.frozen))
+        except (OSError, ValueError) as e:
+            LOG.info('Lmod: can not read frozen environment %s (%s)', args.frozen, e)
+            return False
+        if frozen.get('version') != 2:
+            LOG.info('Lmod: unknown frozen environment version, loading modules')
+            return False
+        if (frozen['purge'], frozen['modules']) != (args.purge, args.module):
+            LOG.info('Lmod: frozen environment is for other modules, loading modules')
+            return False
+        if frozen['fingerprint'] != json.loads(json.dumps(lmod_fingerprint())):
+            LOG.info('Lmod: module tree changed since setup, loading modules')
+            return False
+        changed = [name for (name, value) in frozen['base'].items()
+                   if os.environ.get(name) != value]
+        if changed:
+            LOG.info('Lmod: environment differs from setup (%s), loading modules',
+                     ' '.join(sorted(changed)))
+            return False
+        LOG.debug('Lmod: using frozen environment from %s', args.frozen)
+        apply_env_delta(frozen['delta'])
+        return True
+
     def run(self):
         """load modules and run:
 
@@ -282,10 +1835,9 @@ class lmod(envkernel):
         after '--': the Python command to run after loading"""
         super().run()
         argv, rest = split_doubledash(self.argv, 1)
-        parser = argparse.ArgumentParser()
-        parser.add_argument('--purge', action='store_true', default=False, help="Purge existing modules first")
-        parser.add_argument('module', nargs='+')
+        parser = self._run_parser()
         args, unknown_args = parser.parse_known_args(argv)
+        self.mark('parse', target=' '.join(args.module))
 
         #print(args)
         #print('stderr', args, file=sys.stderr)
@@ -294,41 +1846,172 @@ class lmod(envkernel):
 
         #LMOD_INIT = os.environ['LMOD_PKG']+'/init/env_modules_python.py'
         #exec(compile(open(LMOD_INIT).read(), LMOD_INIT, 'exec'))
-        def module(command, *arguments):
-            """Copy of the lmod command above, but works on python2&3
-
-            ... to work around old lmod installations that don't have
-            python3 support.
-            """
-            commands = os.popen(
-                '%s/libexec/lmod python %s %s'\
-                % (os.environ['LMOD_PKG'], command, ' '.join(arguments))).read()
-            exec(commands)
-        if args.purge:
-            LOG.debug('Lmod purging')
-            module('purge')
-        LOG.debug('Lmod loading ' + ' '.join(args.module))
-        module('load', *args.module)
+        if args.frozen and self._load_frozen(args):
+            pass
+        elif args.cache:
+            key = ['lmod', args.purge, args.module, environ_key(), lmod_fingerprint()]
+            load = lambda: self._load(args.purge, args.module)
+            apply_env_delta(cached_env_delta('lmod', key, load,
+                                             directory=args.cache_dir,
+                                             max_size=args.cache_size))
+        else:
+            self._load(args.purge, args.module)
+        # Modules prepend to paths which may have had the same
+        # directories already, for example when Jupyter was started from
+        # a shell with the same modules loaded.
+        apply_edits([('prune' if args.prune_paths else 'dedup', name) for name in PATH_VARS])
+        apply_edits(self.path_cleanup_edits(False, args.lib_cache))
 
         LOG.debug('envkernel running: %s', printargs(rest))
         LOG.debug('PATH: %s', os.environ['PATH'])
-        self.execvp(rest[0], rest)
+        self.exec_kernel(rest)
+
+
+
+def spack_fingerprint(spack_cmd='spack', spack_env=None, extra=(), environ=None):
+    """Data which changes when the installed Spack packages change.
+
+    This is the mtime of Spack's install database and configuration,
+    and of the environment's spack.yaml/spack.lock."""
+    import shutil
+    if environ is None:
+        environ = os.environ
+    root = environ.get('SPACK_ROOT')
+    if not root:
+        found = shutil.which(spack_cmd, path=environ.get('PATH'))
+        root = os.path.dirname(os.path.dirname(os.path.realpath(found or spack_cmd)))
+    paths = [pjoin(root, 'opt', 'spack', '.spack-db', 'index.json'),
+             pjoin(root, 'etc', 'spack'),
+             environ.get('SPACK_USER_CONFIG_PATH') or os.path.expanduser('~/.spack'),
+             *extra]
+    if spack_env:
+        if os.sep in spack_env:
+            env_dir = spack_env
+        else:
+            env_dir = pjoin(root, 'var', 'spack', 'environments', spack_env)
+        paths.extend([pjoin(env_dir, 'spack.yaml'), pjoin(env_dir, 'spack.lock')])
+    return mtimes(paths)
+
+
+
+class spack(envkernel):
+    """Load Spack packages, or activate a Spack environment, then run the kernel.
+
+    `spack load --sh` takes seconds, so the resulting environment is
+    cached (see cached_env_delta), keyed by the specs and the mtimes of
+    Spack's database."""
+    def setup(self):
+        super().setup()
+        run_args, _ = self._run_parser().parse_known_args(self.argv)
+        LOG.debug('setup: args: %s', run_args)
+        if not run_args.spec and not run_args.spack_env:
+            LOG.critical("ERROR: give Spack specs to load, or --spack-env")
+            sys.exit(1)
+
+        kernel = self.get_kernel()
+        kernel['argv'] = [
+            *self.envkernel_argv(),
+            self.__class__.__name__, 'run',
+            *self.argv,
+            '--',
+            *kernel['argv'],
+        ]
+        if 'display_name' not in kernel:
+            kernel['display_name'] = "Spack {}".format(run_args.spack_env or ' '.join(run_args.spec))
+        self.install_kernel(kernel, name=self.name, user=self.user,
+                            replace=self.replace, prefix=self.prefix)
+
+    def _run_parser(self):
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--spack-env',
+                            help="Spack environment (name or directory) to activate")
+        parser.add_argument('--spack', default='spack', help="spack command (default 'spack')")
+        parser.add_argument('--no-cache', action='store_true',
+                            help="Run spack at every start, don't cache the environment")
+        parser.add_argument('--cache-dir',
+                            help="Cache directory (default ~/.cache/envkernel)")
+        parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE,
+                            help="Maximum size of the cache directory in MB")
+        self.add_path_options(parser)
+        parser.add_argument('--fingerprint', action='append', default=[ ],
+                            help="Also redo the load when the mtime of this path changes "
+                                 "(for example, a database in a non-default install_tree)")
+        parser.add_argument('spec', nargs='*', help="Specs to load")
+        return parser
+
+    def _load(self, args):
+        """Run spack, return the environment delta"""
+        import subprocess
+        if args.spack_env:
+            cmd = [args.spack, 'env', 'activate', '--sh', args.spack_env]
+        else:
+            cmd = [args.spack, 'load', '--sh', *args.spec]
+        LOG.debug('spack: running %s', printargs(cmd))
+        out = subprocess.check_output(
+            ['bash', '-c', 'script=$("$@") || exit 1; eval "$script" >&2; env -0', 'bash', *cmd])
+        environ = dict(x.split('=', 1) for x in out.decode().split('\0') if '=' in x)
+        delta = env_delta(os.environ, environ)
+        return {k: v for (k, v) in delta.items() if not cache_ignored(k)}
+
+    def run(self):
+        """Load the specs or environment, and run the command after '--'"""
+        super().run()
+        argv, rest = split_doubledash(self.argv, 1)
+        args, unknown_args = self._run_parser().parse_known_args(argv)
+        self.mark('parse', target=args.spack_env or ' '.join(args.spec))
+        LOG.debug('run: args: %s', args)
+        LOG.debug('run: remaining args: %s', unknown_args)
+
+        if args.no_cache:
+            apply_env_delta(self._load(args))
+        else:
+            key = ['spack', args.spack_env, args.spec, environ_key(),
+                   spack_fingerprint(args.spack, args.spack_env, args.fingerprint)]
+            apply_env_delta(cached_env_delta('spack', key, lambda: self._load(args),
+                                             directory=args.cache_dir,
+                                             max_size=args.cache_size))
+        apply_edits(self.path_cleanup_edits(args.prune_paths, args.lib_cache))
+
+        LOG.debug('envkernel running: %s', printargs(rest))
+        self.exec_kernel(rest)
 
 
 
 class conda(envkernel):
     def setup(self):
+        import argparse
         super().setup()
         parser = argparse.ArgumentParser()
+        parser.add_argument('--compile', action='store_true',
+                            help="Compile the environment's Python files now, so that the "
+                                 "first start doesn't have to")
         parser.add_argument('path')
         args, unknown_args = parser.parse_known_args(self.argv)
 
         kernel = self.get_kernel()
         path = args.path
         path = os.path.abspath(path)
+        # Bytecode for a read-only environment goes to a per-user cache.
+        if (args.compile and '--pycache-prefix' not in unknown_args
+                and not os.access(pjoin(path, 'lib'), os.W_OK)):
+            unknown_args.append('--pycache-prefix')
+        # Without --activate, the environment changes are static and
+        # can go into a launch plan.
+        plan_argv = [ ]
+        # With --stage, the path is only known at run time.
+        plan = '--stage' not in unknown_args and format_plan(self.__class__.__name__, path, [
+            *self.path_edits(path),
+            *self.path_cleanup_edits('--prune-paths' in unknown_args, '--lib-cache' in unknown_args),
+            *(self.pycache_edits if '--pycache-prefix' in unknown_args else [ ])])
+        if '--activate' not in unknown_args and plan:
+            plan_file = self.plan_prefix + cache_key(plan)[:12]
+            self.write_files[plan_file] = plan
+            plan_argv = ['--plan={resource_dir}/'+plan_file]
         kernel['argv'] = [
-            os.path.realpath(sys.argv[0]),
+            *self.envkernel_argv(),
             self.__class__.__name__, 'run',
+            *plan_argv,
             *unknown_args,
             path,
             '--',
@@ -348,9 +2031,35 @@ class conda(envkernel):
                 print(self.notfound_message%(self.__class__.__name__, path+'/bin'))
                 LOG.critical("ERROR: %s bin does not exist: %s/bin", self.__class__.__name__, path)
                 sys.exit(1)
+        if args.compile:
+            self._compile(path, kernel['argv'], pycache='--pycache-prefix' in unknown_args)
         self.install_kernel(kernel, name=self.name, user=self.user,
                             replace=self.replace, prefix=self.prefix)
 
+    # Run option --pycache-prefix: bytecode goes to the user's cache
+    pycache_edits = [('cache-dir', 'PYTHONPYCACHEPREFIX', 'pycache')]
+
+    def _compile(self, path, kernel_argv, pycache=False):
+        """Compile the environment's site-packages and the kernel's imports"""
+        import subprocess
+        python = pjoin(path, 'bin', 'python')
+        if not os.path.exists(python):
+            LOG.warning("compile: %s not found, not compiling", python)
+            return
+        modules = [ ]
+        if 'ipykernel_launcher' in kernel_argv:
+            modules = ['ipykernel_launcher', 'ipykernel.kernelapp']
+        environ = dict(os.environ)
+        apply_edits(self.path_edits(path), environ)
+        if pycache:
+            apply_edits(self.pycache_edits, environ)
+            LOG.info("  Environment is read-only, compiling to %s", environ['PYTHONPYCACHEPREFIX'])
+        LOG.info("  Compiling the Python files of %s", path)
+        p = subprocess.run([python, '-c', COMPILE_PROGRAM, *modules], env=environ,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for line in p.stderr.decode(errors='replace').splitlines():
+            LOG.warning("compile: %s", line)
+
     notfound_message = """\
 ERROR: %s path does not exist: %s
 
@@ -371,12 +2080,32 @@ $CONDA_PREFIX like such:
 
         before '--': the modules to load
         after '--': the Python command to run after loading"""
+        import argparse
         super().run()
         argv, rest = split_doubledash(self.argv, 1)
         parser = argparse.ArgumentParser()
         #parser.add_argument('--purge', action='store_true', default=False, help="Purge existing modules first")
+        parser.add_argument('--activate', action='store_true',
+                            help="Fully activate the environment, including activate.d scripts (conda)")
+        parser.add_argument('--cache-dir',
+                            help="Cache directory (default ~/.cache/envkernel)")
+        parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE,
+                            help="Maximum size of the cache directory in MB")
+        parser.add_argument('--plan', help="Launch plan written by setup (internal use)")
+        parser.add_argument('--pycache-prefix', action='store_true',
+                            help="Write bytecode to the user's cache instead of the environment")
+        parser.add_argument('--stage', action='store_true',
+                            help="Copy the environment to node-local disk, and use the copy")
+        parser.add_argument('--stage-dir',
+                            help="Directory for the copies (default $ENVKERNEL_STAGE_DIR, or "
+                                 "envkernel-stage-UID in the temporary directory)")
+        parser.add_argument('--stage-size', type=int, default=STAGE_MAX_SIZE,
+                            help="Maximum size of the copies of environments in MB "
+                                 "(default %d)"%STAGE_MAX_SIZE)
+        self.add_path_options(parser)
         parser.add_argument('path')
         args, unknown_args = parser.parse_known_args(argv)
+        self.mark('parse', target=args.path)
 
         #print(args)
         #print('stderr', args, file=sys.stderr)
@@ -391,28 +2120,105 @@ $CONDA_PREFIX like such:
             LOG.critical("%s bin does not exist: %s/bin", self.__class__.__name__, path)
             raise RuntimeError("envkernel: {} path {} does not exist".format(self.__class__.__name__, path+'/bin'))
 
+        if args.stage:
+            args.path = self._stage(args)
+            self.mark('stage')
+
         self._run(args, rest)
 
+    @staticmethod
+    def _stage(args):
+        """Return the path of a node-local copy of the environment"""
+        import glob
+        path = os.path.abspath(args.path)
+        try:
+            directory = stage_dir('environments', base=args.stage_dir)
+        except OSError as e:
+            LOG.warning('stage: can not use stage dir (%s)', e)
+            return path
+        site_packages = glob.glob(pjoin(path, 'lib', 'python*', 'site-packages'))
+        fingerprint = [environment_fingerprint(path), mtimes([pjoin(path, 'bin'), *site_packages])]
+        return stage_environment(path, directory, fingerprint, max_size=args.stage_size)
+
     def _run(self, args, rest):
         path = args.path
-        os.environ['PATH']            = path_join(pjoin(path, 'bin'    ), os.environ.get('PATH', None))
-        os.environ['CPATH']           = path_join(pjoin(path, 'include'), os.environ.get('CPATH', None))
-        os.environ['LD_LIBRARY_PATH'] = path_join(pjoin(path, 'lib'    ), os.environ.get('LD_LIBRARY_PATH', None))
-        os.environ['LIBRARY_PATH']    = path_join(pjoin(path, 'lib'    ), os.environ.get('LIBRARY_PATH', None))
+        if args.activate:
+            key = ['conda', path, environ_key(),
+                   mtimes([pjoin(path, 'conda-meta', 'history'),
+                           pjoin(path, 'conda-meta', 'state'),
+                           pjoin(path, 'etc', 'conda', 'activate.d')])]
+            apply_env_delta(cached_env_delta('conda', key, lambda: self._activate(path),
+                                             directory=args.cache_dir,
+                                             max_size=args.cache_size))
+        else:
+            apply_edits(self.path_edits(path))
+        apply_edits(self.path_cleanup_edits(args.prune_paths, args.lib_cache))
+        if args.pycache_prefix:
+            apply_edits(self.pycache_edits)
+
+        self.exec_kernel(rest)
+
+    @staticmethod
+    def path_edits(path):
+        """Environment edits (see apply_edits) which put the environment first"""
+        return [
+            ('prepend', 'PATH',            pjoin(path, 'bin'    )),
+            ('prepend', 'CPATH',           pjoin(path, 'include')),
+            ('prepend', 'LD_LIBRARY_PATH', pjoin(path, 'lib'    )),
+            ('prepend', 'LIBRARY_PATH',    pjoin(path, 'lib'    )),
+            ]
 
-        self.execvp(rest[0], rest)
+    def _activate(self, path):
+        """Do what `conda activate` does, return the environment delta.
+
+        This sets the paths like the normal mode, the CONDA_* variables,
+        the environment's own variables (`conda env config vars`), and
+        then sources the etc/conda/activate.d/*.sh scripts."""
+        import glob
+        import json
+        import subprocess
+        LOG.debug('conda: activating %s', path)
+        environ = dict(os.environ)
+        apply_edits(self.path_edits(path), environ)
+        shlvl = int(environ.get('CONDA_SHLVL') or 0)
+        if environ.get('CONDA_PREFIX'):
+            environ['CONDA_PREFIX_%d'%shlvl] = environ['CONDA_PREFIX']
+        name = os.path.basename(path.rstrip('/'))
+        environ['CONDA_SHLVL'] = str(shlvl + 1)
+        environ['CONDA_PREFIX'] = path
+        environ['CONDA_DEFAULT_ENV'] = name
+        environ['CONDA_PROMPT_MODIFIER'] = '(%s) '%name
+        try:
+            state = json.load(open(pjoin(path, 'conda-meta', 'state')))
+            environ.update(state.get('env_vars', {}))
+        except (OSError, ValueError):
+            pass
+        scripts = sorted(glob.glob(pjoin(path, 'etc', 'conda', 'activate.d', '*.sh')))
+        if scripts:
+            LOG.debug('conda: sourcing %s', scripts)
+            out = subprocess.check_output(
+                ['bash', '-c', 'for f in "$@"; do . "$f" >&2; done; env -0', 'bash', *scripts],
+                env=environ)
+            environ = dict(x.split('=', 1) for x in out.decode().split('\0') if '=' in x)
+        delta = env_delta(os.environ, environ)
+        return {k: v for (k, v) in delta.items() if not cache_ignored(k)}
 
 
 
 class virtualenv(conda):
     def _run(self, args, rest):
-        path = args.path
-        os.environ.pop('PYTHONHOME', None)
-        os.environ['PATH'] = path_join(pjoin(path, 'bin'), os.environ.get('PATH', None))
-        if 'PS1' in os.environ:
-            os.environ['PS1'] = "(venv3) " + os.environ['PS1']
-
-        self.execvp(rest[0], rest)
+        apply_edits([*self.path_edits(args.path),
+                     *self.path_cleanup_edits(args.prune_paths, args.lib_cache),
+                     *(self.pycache_edits if args.pycache_prefix else [ ])])
+        self.exec_kernel(rest)
+
+    @staticmethod
+    def path_edits(path):
+        return [
+            ('unset', 'PYTHONHOME'),
+            ('prepend', 'PATH', pjoin(path, 'bin')),
+            ('prefix', 'PS1', "(venv3) "),
+            ]
     notfound_message = """\
 ERROR: %s path does not exist: %s
 
@@ -429,43 +2235,114 @@ class venv(virtualenv):
 
 class docker(envkernel):
     def setup(self):
+        import argparse
         super().setup()
         parser = argparse.ArgumentParser()
+        parser.add_argument('--pin-digest', action='store_true',
+                            help="Store the ID of the local image instead of its name, and "
+                                 "never pull at kernel start")
+        parser.add_argument('--refresh', action='store_true',
+                            help="Pull the image first, then pin it (implies --pin-digest)")
         parser.add_argument('image')
         args, unknown_args = parser.parse_known_args(self.argv)
         LOG.debug('setup: %s', args)
 
+        image = args.image
+        image_argv = [ ]
+        if args.pin_digest or args.refresh:
+            image = self._image_id(args.image, pull=args.refresh)
+            if image is None:
+                LOG.critical("ERROR: docker image %s is not present locally.  Pull it first, "
+                             "or use --refresh.", args.image)
+                sys.exit(1)
+            LOG.info("  Pinned image %s to %s", args.image, image)
+            image_argv = ['--image-name='+args.image]
+
         kernel = self.get_kernel()
         kernel['argv'] = [
-            os.path.realpath(sys.argv[0]),
+            *self.envkernel_argv(),
             'docker',
             'run',
             '--connection-file', '{connection_file}',
-            args.image,
+            *image_argv,
+            image,
             *unknown_args,
             '--',
             *kernel['argv'],
         ]
         if 'display_name' not in kernel:
-            kernel['display_name'] = "Docker with {}".format(args.image),
+            kernel['display_name'] = "Docker with {}".format(args.image)
         self.install_kernel(kernel, name=self.name, user=self.user,
                             replace=self.replace, prefix=self.prefix)
 
+    @staticmethod
+    def _image_id(image, pull=False):
+        """The ID (sha256:...) of a local image, or None if it isn't present"""
+        import subprocess
+        if pull:
+            LOG.info("  Pulling %s", image)
+            if subprocess.call(['docker', 'pull', '-q', image], stdout=subprocess.DEVNULL) != 0:
+                LOG.warning("docker: could not pull %s", image)
+        try:
+            out = subprocess.check_output(['docker', 'image', 'inspect', '--format={{.Id}}', image],
+                                          stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return out.decode().strip() or None
+
     def run(self):
+        import argparse
+        import json
+        import re
+        import shutil
+        import tempfile
         super().run()
-        argv, rest = split_doubledash(self.argv, 1)
+        # --pool-fill-only (from cron) has no kernel command, so maybe no '--'.
+        argv, *rest = split_doubledash(self.argv, 1)
+        rest = rest[0] if rest else [ ]
         parser = argparse.ArgumentParser()
         parser.add_argument('image', help='Docker image name')
+        parser.add_argument('--image-name', help="Name of a pinned image (set by setup)")
         #parser.add_argument('--mount', '-m', action='append', default=[],
         #                        help='mount to set up, format hostDir:containerMountPoint')
         parser.add_argument('--copy-workdir', default=False, action='store_true')
+        parser.add_argument('--copy-method', choices=['auto', 'hardlink', 'copy'], default='auto',
+                            help="How to copy `,copy` mounts: auto (reflink if the filesystem "
+                                 "supports it, otherwise copy), hardlink, or copy.")
+        parser.add_argument('--copy-dir',
+                            help="Directory to copy `,copy` mounts into (default: the system "
+                                 "temporary directory).  Reflinks and hardlinks only work within "
+                                 "the same filesystem.")
+        parser.add_argument('--copy-max-size', type=int,
+                            help="Refuse to start if a `,copy` mount is bigger than this (MB).")
+        parser.add_argument('--copy-exclude', action='append', default=[],
+                            help="Glob of names or relative paths not to copy (can be repeated).")
         parser.add_argument('--pwd', action='store_true',
                             help="Also mount the Jupyter working directory (containing the notebook) "
                                  "in the image.  This is needed if you want to access data from this dir.")
         parser.add_argument('--workdir', help='Location to mount working dir inside the container')
         parser.add_argument('--connection-file', help="Do not use, internal use.")
+        parser.add_argument('--host-network', action='store_true',
+                            help="Run the container in the host network, without forwarding "
+                                 "the kernel's ports (falls back to forwarding if a port is in use).")
+        parser.add_argument('--pool', type=int, default=0,
+                            help="Keep this many idle containers ready to start kernels in.")
+        parser.add_argument('--pool-idle-timeout', type=int, default=600,
+                            help="Seconds before an unused pool container exits (default 600).")
+        parser.add_argument('--pool-refill', choices=['start', 'never'], default='start',
+                            help="When to start new pool containers: at each kernel start (default), "
+                                 "or never (fill the pool with --pool-fill-only).")
+        parser.add_argument('--pool-fill-only', action='store_true',
+                            help="Only fill the pool, don't start a kernel (for cron jobs).")
 
         args, unknown_args = parser.parse_known_args(argv)
+        self.mark('parse', target=args.image_name or args.image)
+
+        # A pinned image (by ID) is never pulled: starting a kernel
+        # should not wait for a registry.  If the image is gone, docker
+        # run says so.
+        if args.image.startswith('sha256:'):
+            unknown_args.insert(0, '--pull=never')
 
         extra_mounts = [ ]
 
@@ -477,20 +2354,75 @@ class docker(envkernel):
             # src = host data, dst=container mountpoint
             extra_mounts.extend(["--mount", "type=bind,source={},destination={},ro={}{}".format(os.getcwd(), workdir, 'false', ',copy' if args.copy_workdir else '')])
 
+        # Pool containers use the host network, so the pool is only
+        # used when that is possible.
+        pool_options = unknown_args + extra_mounts
+        if args.pool:
+            if args.copy_workdir or any(',copy' in x for x in unknown_args):
+                LOG.info('docker: pool can not be used with copied mounts')
+                args.pool = 0
+            elif not self._host_network_ok(None, pool_options, 'not using the pool'):
+                args.pool = 0
+        if args.pool_fill_only:
+            # There is no kernel, so no connection file either.
+            if not args.pool:
+                LOG.critical('docker: --pool-fill-only: no pool to fill (needs --pool=N)')
+                sys.exit(1)
+            pool_dir = cache_dir('docker-pool', cache_key(args.image, pool_options, os.getuid()))
+            self._pool_refill(pool_dir, args.image, pool_options,
+                              args.pool, args.pool_idle_timeout)
+            return 0
+
+        # Parse connection file
+        connection_file = args.connection_file
+        connection_data = json.load(open(connection_file))
+        ipc = connection_data.get('transport') == 'ipc'
+
+        # Start in an idle container from the pool, if there is one.
+        if args.pool:
+            if ipc:
+                LOG.info('docker: pool can not be used with the ipc transport')
+            elif self._host_network_ok(connection_data, pool_options, 'not using the pool'):
+                pool_dir = cache_dir('docker-pool', cache_key(args.image, pool_options, os.getuid()))
+                container = self._pool_claim(pool_dir, args.pool_idle_timeout,
+                                             args.connection_file, rest)
+                if args.pool_refill == 'start':
+                    self._pool_refill_background(pool_dir, args.image, pool_options,
+                                                 args.pool, args.pool_idle_timeout)
+                if container:
+                    cmd = ['docker', 'attach', '--sig-proxy=true', container]
+                    LOG.info('docker: running cmd = %s', printargs(cmd))
+                    return self.exec_kernel(cmd)
+                LOG.info('docker: pool is empty, starting a new container')
+
         cmd = [
             "docker", "run", "--rm", "-i",
             "--user", "%d:%d"%(os.getuid(), os.getgid()),
             ]
 
-        # Parse connection file
-        connection_file = args.connection_file
-        connection_data = json.load(open(connection_file))
-        # Find all the (five) necessary ports
-        for var in ('shell_port', 'iopub_port', 'stdin_port', 'control_port', 'hb_port'):
-            # Forward each port to itself
-            port = connection_data[var]
-            #expose_ports.append((connection_data[var], connection_data[var]))
-            cmd.extend(['--expose={}'.format(port), "-p", "{}:{}".format(port, port)])
+        host_network = args.host_network and not ipc and self._host_network_ok(connection_data, unknown_args)
+        if ipc:
+            # The sockets are files named {ip}-{port}: mount their
+            # directory at the same place.  A relative ip (the default,
+            # "kernel-ipc") would be relative to the container's working
+            # directory, so the kernel gets the absolute path.
+            connection_data['ip'] = os.path.abspath(connection_data['ip'])
+            open(connection_file, 'w').write(json.dumps(connection_data))
+            socket_dir = os.path.dirname(connection_data['ip'])
+            extra_mounts.extend(["--mount",
+                                 "type=bind,source={},destination={},ro=false".format(
+                                     socket_dir, socket_dir)])
+        elif host_network:
+            # The kernel binds the ports on the host directly, so
+            # nothing is forwarded and the connection file is used as is.
+            cmd.append('--network=host')
+        else:
+            # Find all the (five) necessary ports
+            for var in self.PORT_NAMES:
+                # Forward each port to itself
+                port = connection_data[var]
+                #expose_ports.append((connection_data[var], connection_data[var]))
+                cmd.extend(['--expose={}'.format(port), "-p", "{}:{}".format(port, port)])
         # Mount the connection file inside the container
         extra_mounts.extend(["--mount",
                              "type=bind,source={},destination={},ro={}".format(
@@ -499,9 +2431,10 @@ class docker(envkernel):
                             ])
         #expose_mounts.append(dict(src=json_file, dst=json_file))
 
-        # Change connection_file to bind to all IPs.
-        connection_data['ip'] = '0.0.0.0'
-        open(connection_file, 'w').write(json.dumps(connection_data))
+        if not ipc and not host_network:
+            # Change connection_file to bind to all IPs.
+            connection_data['ip'] = '0.0.0.0'
+            open(connection_file, 'w').write(json.dumps(connection_data))
 
         # Add options to expose the ports
 #       for port_host, port_container in expose_ports:
@@ -529,16 +2462,26 @@ class docker(envkernel):
                 arg = arg + ',copy'
             arg.format(workdir=os.getcwd)
             if ',copy' in arg:
-                src_original = re.search('src=([^,]+)', arg).group(1)
+                src_original = re.search('(?:src|source)=([^,]+)', arg).group(1)
                 # Copy the source directory
-                tmpdir = tempfile.TemporaryDirectory(prefix='jupyter-secure-')
+                tmpdir = tempfile.mkdtemp(prefix='jupyter-secure-', dir=args.copy_dir)
                 tmpdirs.append(tmpdir)
-                src = tmpdir.name + '/copy'
-                shutil.copytree(src_original, src)
+                src = tmpdir + '/copy'
+                try:
+                    stage_tree(src_original, src, method=args.copy_method,
+                               exclude=args.copy_exclude,
+                               max_size=args.copy_max_size and args.copy_max_size*2**20)
+                except BaseException:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    raise
                 #
-                newarg = re.sub('src=([^,]+)', 'src='+src, arg) # add in new src
+                newarg = re.sub('(src|source)=([^,]+)', lambda m: m.group(1)+'='+src, arg) # add in new src
                 newarg = re.sub(',copy', '', newarg)            # remove ,copy
                 unknown_args[i] = newarg
+        # execvp replaces this process, so the copies are removed by a
+        # background process once the kernel exits.
+        if tmpdirs:
+            self.cleanup_after_exit(tmpdirs)
 
         # Image name
 #       cmd.append(args.image)
@@ -553,19 +2496,139 @@ class docker(envkernel):
 
         # Run...
         LOG.info('docker: running cmd = %s', printargs(cmd))
-        ret = self.execvp(cmd[0], cmd)
-
-        # Clean up all temparary directories
-        for tmpdir in tmpdirs:
-            tmpdir.cleanup()
+        ret = self.exec_kernel(cmd)
         return(ret)
 
+    PORT_NAMES = ('shell_port', 'iopub_port', 'stdin_port', 'control_port', 'hb_port')
+
+    def _host_network_ok(self, connection_data, options, fallback='forwarding ports'):
+        """Whether the host network can be used, otherwise log why not
+
+        Without connection_data (filling the pool), the kernel's ports
+        are not checked."""
+        import socket
+        if not sys.platform.startswith('linux'):
+            LOG.info('docker: host network only works on Linux, %s', fallback)
+            return False
+        if any(x.split('=')[0] in ('--network', '--net') for x in options):
+            LOG.info('docker: network given in the options, %s', fallback)
+            return False
+        if connection_data is None:
+            return True
+        for var in self.PORT_NAMES:
+            port = connection_data[var]
+            s = socket.socket(socket.AF_INET6 if ':' in connection_data['ip'] else socket.AF_INET)
+            try:
+                # Like zmq, which also sets SO_REUSEADDR
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind((connection_data['ip'], port))
+            except OSError as e:
+                LOG.info('docker: can not use port %s on the host (%s), %s', port, e, fallback)
+                return False
+            finally:
+                s.close()
+        return True
+
+    # Pool of idle containers.  Each pool container has its own slot
+    # directory on the host, bind-mounted to POOL_MOUNT.  The container
+    # waits until a kernel start writes the kernel command to run.sh
+    # in it, and then execs that.  Idle containers exit by themselves
+    # after the idle timeout.  Pool containers use the host network,
+    # since the kernel's ports are not known when they are created,
+    # so the connection file is used unchanged.
+    POOL_MOUNT = '/envkernel-pool'
+    POOL_WAITER = ('i=0; while [ ! -e {mount}/run.sh ]; do '
+                   'sleep 0.1; i=$((i+1)); [ $i -gt {ticks} ] && exit 0; done; '
+                   'exec sh {mount}/run.sh')
+
+    @staticmethod
+    def _pool_slots(pool_dir, idle_timeout, cleanup=False):
+        """Return the ready slot directories in a pool, oldest first.
+
+        With cleanup, also remove expired slots and claimed slots
+        whose kernel has had time to start."""
+        import shutil
+        import time
+        slots = [ ]
+        now = time.time()
+        for fname in os.listdir(pool_dir):
+            slot = pjoin(pool_dir, fname)
+            try:
+                if fname.endswith('.claimed'):
+                    if cleanup and now - os.stat(slot).st_mtime > 60:
+                        shutil.rmtree(slot, ignore_errors=True)
+                    continue
+                created = os.stat(pjoin(slot, 'container')).st_mtime
+            except OSError:
+                continue  # not ready yet, or just claimed
+            # Leave a margin so that we never claim a container which
+            # is just about to exit.
+            if now - created < idle_timeout - 10:
+                slots.append((created, slot))
+            elif cleanup:
+                shutil.rmtree(slot, ignore_errors=True)
+        return [slot for (_, slot) in sorted(slots)]
+
+    def _pool_claim(self, pool_dir, idle_timeout, connection_file, rest):
+        """Claim an idle container and start the kernel in it.
+
+        Returns the container ID, or None if no container is ready."""
+        import shutil
+        for slot in self._pool_slots(pool_dir, idle_timeout):
+            claimed = slot + '.claimed'
+            try:
+                os.rename(slot, claimed)  # atomic, so only one start gets it
+            except OSError:
+                continue
+            container = open(pjoin(claimed, 'container')).read().strip()
+            LOG.debug('docker: claimed pool container %s', container)
+            shutil.copy(connection_file, pjoin(claimed, 'connection.json'))
+            rest = [pjoin(self.POOL_MOUNT, 'connection.json') if x == connection_file else x
+                    for x in rest]
+            write_atomic(pjoin(claimed, 'run.sh'), 'exec %s\n'%printargs(rest))
+            return container
+        return None
+
+    def _pool_refill(self, pool_dir, image, options, size, idle_timeout):
+        """Start new idle containers until the pool has `size` of them."""
+        import subprocess
+        import tempfile
+        with locked(pjoin(pool_dir, '.lock')):
+            missing = size - len(self._pool_slots(pool_dir, idle_timeout, cleanup=True))
+            for _ in range(missing):
+                slot = tempfile.mkdtemp(dir=pool_dir, prefix='slot-')
+                os.chmod(slot, 0o755)
+                waiter = self.POOL_WAITER.format(mount=self.POOL_MOUNT, ticks=idle_timeout*10)
+                cmd = [
+                    'docker', 'run', '-d', '--rm', '--network=host',
+                    '--user', '%d:%d'%(os.getuid(), os.getgid()),
+                    '--mount', 'type=bind,source={},destination={},ro=false'.format(slot, self.POOL_MOUNT),
+                    *options,
+                    image,
+                    'sh', '-c', waiter,
+                    ]
+                LOG.debug('docker: starting pool container: %s', printargs(cmd))
+                try:
+                    container = subprocess.check_output(cmd).decode().strip()
+                except (OSError, subprocess.CalledProcessError) as e:
+                    LOG.warning('docker: could not start pool container: %s', e)
+                    os.rmdir(slot)
+                    return
+                write_atomic(pjoin(slot, 'container'), container)
+
+    def _pool_refill_background(self, *args):
+        run_detached(self._pool_refill, *args)
+
 
 class singularity(envkernel):
     def setup(self):
         """Install a new singularity kernelspec"""
+        import argparse
         super().setup()
         parser = argparse.ArgumentParser()
+        parser.add_argument('--stage-checksum', action='store_true',
+                            help="Store the checksum of the image, and only use staged "
+                                 "copies which match it (implies --stage)")
         parser.add_argument('image')
         args, unknown_args = parser.parse_known_args(self.argv)
         LOG.debug('setup: args: %s', args)
@@ -573,8 +2636,14 @@ class singularity(envkernel):
 
         kernel = self.get_kernel()
         image = os.path.abspath(args.image)
+        if args.stage_checksum:
+            try:
+                unknown_args = ['--stage', '--stage-sha256='+file_sha256(image), *unknown_args]
+            except OSError as e:
+                LOG.critical("ERROR: can not read image %s: %s", image, e)
+                sys.exit(1)
         kernel['argv'] = [
-            os.path.realpath(sys.argv[0]),
+            *self.envkernel_argv(),
             'singularity', 'run',
             '--connection-file', '{connection_file}',
             #*[ '--mount={}'.format(x) for x in args.mount],
@@ -589,6 +2658,9 @@ class singularity(envkernel):
                             replace=self.replace, prefix=self.prefix)
 
     def run(self):
+        import argparse
+        import json
+        import shlex
         super().run()
         argv, rest = split_doubledash(self.argv, 1)
         parser = argparse.ArgumentParser()
@@ -598,11 +2670,35 @@ class singularity(envkernel):
         #parser.add_argument('--copy-pwd', default=False, action='store_true')
         parser.add_argument('--pwd', action='store_true')
         parser.add_argument('--connection-file')
+        parser.add_argument('--instance', action='store_true',
+                            help="Run kernels in a persistent instance of the image, shared by "
+                                 "all kernels with the same image and options.")
+        parser.add_argument('--instance-grace', type=int, default=60,
+                            help="Seconds to keep the instance after the last kernel exits.")
+        parser.add_argument('--stage', action='store_true',
+                            help="Copy the image to node-local disk at first use, and run the copy.")
+        parser.add_argument('--stage-dir',
+                            help="Directory for the copies (default $ENVKERNEL_STAGE_DIR, or "
+                                 "envkernel-stage-UID in the temporary directory)")
+        parser.add_argument('--stage-size', type=int, default=STAGE_MAX_SIZE,
+                            help="Maximum size of the copies of images in MB (default %d)"%STAGE_MAX_SIZE)
+        parser.add_argument('--stage-sha256', help="Checksum of the image (set by setup)")
         args, unknown_args = parser.parse_known_args(argv)
+        self.mark('parse', target=args.image)
         LOG.debug('run: args: %s', args)
         LOG.debug('run: remaining args: %s', unknown_args)
         LOG.debug('run: rest: %s', rest)
 
+        if args.stage and os.path.isfile(args.image):
+            try:
+                directory = stage_dir('singularity', base=args.stage_dir)
+            except OSError as e:
+                LOG.warning('stage: can not use stage dir (%s)', e)
+            else:
+                args.image = stage_file(args.image, directory, max_size=args.stage_size,
+                                        sha256=args.stage_sha256)
+            self.mark('stage')
+
         extra_args = [ ]
 
         # Find connection file and mount it:
@@ -611,9 +2707,40 @@ class singularity(envkernel):
         # have any extra files mounted inside of it.  This means that
         # we have to relocate the connection file to "/" or somewhere.
         new_connection_file = "/"+os.path.basename(connection_file)
-        if False:
+        # With the ipc transport, the same goes for the directory with
+        # the sockets ({ip}-{port}), so it is mounted at IPC_MOUNT and
+        # the kernel gets a connection file with the new ip.
+        connection_data = json.load(open(connection_file))
+        ipc_args = [ ]
+        if connection_data.get('transport') == 'ipc':
+            socket_dir = os.path.dirname(os.path.abspath(connection_data['ip']))
+            ipc_args = ['--bind', socket_dir+':'+self.IPC_MOUNT]
+            connection_data['ip'] = pjoin(self.IPC_MOUNT, os.path.basename(connection_data['ip']))
+        if args.instance:
+            # Binds can't be added to a running instance, so the
+            # connection file is copied into a directory which is
+            # bound when the instance starts.
+            name = 'envkernel-' + cache_key(args.image, unknown_args, args.pwd and os.getcwd(),
+                                            ipc_args, os.getuid())[:16]
+            instance_dir = cache_dir('singularity-instances', name)
+            connection_dir = pjoin(instance_dir, 'connection')
+            os.makedirs(connection_dir, mode=0o700, exist_ok=True)
+            os.chmod(connection_dir, 0o700)
+            new_connection_file = pjoin(self.INSTANCE_MOUNT, os.path.basename(connection_file))
+            connection_copy = pjoin(connection_dir, os.path.basename(connection_file))
+            write_private(connection_copy, json.dumps(connection_data))
+            instance_args = ['--bind', connection_dir+':'+self.INSTANCE_MOUNT, *ipc_args]
+        elif ipc_args:
+            # Put the new connection file in the (mounted) socket dir.
+            fname = 'envkernel-'+os.path.basename(connection_file)
+            write_private(pjoin(socket_dir, fname), json.dumps(connection_data))
+            new_connection_file = pjoin(self.IPC_MOUNT, fname)
+            extra_args.extend(ipc_args)
+            self.cleanup_after_exit([pjoin(socket_dir, fname)])
+        elif False:
             # Re-copy connection file to /tmp
             # Doesn't work now!
+            import tempfile
             f = tempfile.NamedTemporaryFile(
                     suffix='-'+os.path.basename(connection_file))
             f.write(open(connection_file, 'rb').read())
@@ -626,7 +2753,10 @@ class singularity(envkernel):
             extra_args.extend(['--bind', connection_file+":"+new_connection_file])
 
         if args.pwd:
-            extra_args.extend(['--bind', os.getcwd()])
+            if args.instance:
+                instance_args.extend(['--bind', os.getcwd()])
+            else:
+                extra_args.extend(['--bind', os.getcwd()])
             extra_args.extend(['--pwd', os.getcwd()])
 
         # Replace the connection file path with the new location.
@@ -638,19 +2768,580 @@ class singularity(envkernel):
         if ('-c' in unknown_args or '--contain' in unknown_args ) and args.pwd:
             rest = ["bash", "-c", "cd %s"%os.getcwd() + " ; exec "+(" ".join(shlex.quote(x) for x in rest))]
 
-        cmd = [
-            'singularity',
-            'exec',
-            *extra_args,
-            *unknown_args,
-            args.image,
-            *rest,
-            ]
+        if args.instance:
+            self._instance_start(instance_dir, name, [*instance_args, *unknown_args, args.image])
+            self._instance_watch_background(instance_dir, name, os.getpid(),
+                                            connection_copy, args.instance_grace)
+            cmd = [
+                'singularity',
+                'exec',
+                *extra_args,
+                'instance://'+name,
+                *rest,
+                ]
+        else:
+            cmd = [
+                'singularity',
+                'exec',
+                *extra_args,
+                *unknown_args,
+                args.image,
+                *rest,
+                ]
 
         LOG.debug('singularity: running cmd= %s', printargs(cmd))
-        ret = self.execvp(cmd[0], cmd)
+        ret = self.exec_kernel(cmd)
         return(ret)
 
+    # Persistent instances.  Each kernel using an instance registers
+    # its PID in the instance's `pids` directory, and a background
+    # process waits for the kernel to exit.  The last one to exit stops
+    # the instance after a grace period.
+    INSTANCE_MOUNT = '/envkernel-connection'
+    IPC_MOUNT = '/envkernel-ipc'
+
+    @staticmethod
+    def _instance_users(instance_dir):
+        """PIDs of the kernels using an instance (removing dead ones)"""
+        pids = [ ]
+        for fname in os.listdir(pjoin(instance_dir, 'pids')):
+            if pid_alive(int(fname)):
+                pids.append(int(fname))
+            else:
+                os.unlink(pjoin(instance_dir, 'pids', fname))
+        return pids
+
+    def _instance_start(self, instance_dir, name, start_args):
+        """Register this kernel, and start the instance if needed."""
+        import subprocess
+        os.makedirs(pjoin(instance_dir, 'pids'), exist_ok=True)
+        with locked(pjoin(instance_dir, 'lock')):
+            open(pjoin(instance_dir, 'pids', str(os.getpid())), 'w').close()
+            running = subprocess.run(['singularity', 'instance', 'list', name],
+                                     stdout=subprocess.PIPE).stdout.decode()
+            if name in running.split():
+                LOG.debug('singularity: using running instance %s', name)
+                return
+            cmd = ['singularity', 'instance', 'start', *start_args, name]
+            LOG.debug('singularity: starting instance: %s', printargs(cmd))
+            subprocess.check_call(cmd, stdout=sys.stderr)
+
+    def _instance_watch(self, instance_dir, name, pid, connection_copy, grace):
+        """Wait for the kernel to exit, then stop the instance if unused."""
+        import subprocess
+        import time
+        wait_pid(pid)
+        os.unlink(connection_copy)
+        with locked(pjoin(instance_dir, 'lock')):
+            if self._instance_users(instance_dir):
+                return
+        time.sleep(grace)
+        with locked(pjoin(instance_dir, 'lock')):
+            if self._instance_users(instance_dir):
+                return
+            LOG.debug('singularity: stopping instance %s', name)
+            subprocess.call(['singularity', 'instance', 'stop', name], stdout=subprocess.DEVNULL)
+
+    def _instance_watch_background(self, *args):
+        run_detached(self._instance_watch, *args)
+
+
+
+def load_manifest(path):
+    """Read a manifest, return (defaults, kernels)
+
+    A manifest is a JSON or TOML (by file extension) list of kernels,
+    or a table with a `kernels` list and optional `defaults` table."""
+    import json
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise RuntimeError("TOML manifests need Python 3.11 or the tomli package")
+        with open(path, 'rb') as f:
+            data = tomllib.load(f)
+    else:
+        with open(path) as f:
+            data = json.load(f)
+    if isinstance(data, list):
+        return { }, data
+    return data.get('defaults', { }), data['kernels']
+
+
+def manifest_argv(entry, defaults={ }):
+    """Command line (mode, argv) for setting up one manifest kernel.
+
+    Each key becomes an option: `"display-name": "X"` is
+    --display-name=X, true is a flag, lists are repeated options and
+    tables give NAME=VALUE options (for `env`).  `args` is a list of
+    (positional) arguments added at the end."""
+    import shlex
+    entry = {**defaults, **entry}
+    mode = entry.pop('mode')
+    args = entry.pop('args', [ ])
+    if isinstance(args, str):
+        args = shlex.split(args)
+    argv = [ ]
+    for key, value in entry.items():
+        opt = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(opt)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, dict):
+            argv.extend('%s=%s=%s'%(opt, k, v) for k, v in value.items())
+        elif isinstance(value, list):
+            argv.extend('%s=%s'%(opt, x) for x in value)
+        else:
+            argv.append('%s=%s'%(opt, value))
+    return mode, argv + [str(x) for x in args]
+
+
+def install_manifest(argv):
+    """Set up all kernels listed in manifest files, in one process.
+
+    Kernels are set up in parallel with one shared KernelSpecManager.
+    A failing kernel is reported and the rest are still installed.
+    Returns 1 if any kernel failed."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='envkernel install-manifest')
+    parser.add_argument('manifest', nargs='+', help="JSON or TOML files listing kernels")
+    parser.add_argument('--jobs', '-j', type=int, default=min(8, os.cpu_count() or 1),
+                        help="Kernels to set up in parallel")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Print the usual setup messages of each kernel")
+    args, extra_args = parser.parse_known_args(argv)
+    # Set once here: the kernels are set up in parallel, and don't
+    # change the log level themselves.
+    level = LOG.level
+    LOG.setLevel(DEBUG if args.verbose else WARNING)
+    try:
+        return _install_manifest(args, extra_args)
+    finally:
+        LOG.setLevel(level)
+
+
+def _install_manifest(args, extra_args):
+    import jupyter_client.kernelspec
+    ksm = jupyter_client.kernelspec.KernelSpecManager()
+    jobs = [ ]
+    failed = 0
+    for path in args.manifest:
+        defaults, kernels = load_manifest(path)
+        for i, entry in enumerate(kernels):
+            name = entry.get('name', '%s#%d'%(path, i))
+            if 'mode' not in entry and 'mode' not in defaults:
+                print('failed: %s: no mode'%name)
+                failed += 1
+                continue
+            mode, kernel_argv = manifest_argv(entry, defaults)
+            jobs.append((name, mode, kernel_argv + extra_args))
+    results = setup_kernels(jobs, ksm, workers=args.jobs)
+    installed = sum(1 for ek in results.values() if ek)
+    failed += len(results) - installed
+    print('%d kernels installed, %d failed'%(installed, failed))
+    return 1 if failed else 0
+
+
+def setup_kernels(jobs, ksm, workers=1):
+    """Set up many kernels in this process, sharing one KernelSpecManager.
+
+    jobs is a list of (name, mode, argv).  Kernels are set up in
+    parallel, except those with options in their mode's
+    serial_setup_options, which are set up one at a time afterwards.
+    Each result is printed as it finishes.  Returns {name: envkernel
+    instance, or None if it failed}."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    print_lock = threading.Lock()
+
+    def setup_one(job):
+        name, mode, argv = job
+        try:
+            if not mode_known(mode):
+                raise ValueError('unknown mode %s'%(mode, ))
+            ek = globals()[mode](argv, ksm=ksm)
+            ek.verify_install = False
+            ek.set_log_level = False
+            ek.setup()
+        except (Exception, SystemExit) as e:
+            # SystemExit is from argparse or a mode's own error message.
+            msg = 'setup failed' if isinstance(e, SystemExit) else str(e)
+            if not isinstance(e, (SystemExit, ValueError)):
+                msg = '%s: %s'%(type(e).__name__, e)
+            with print_lock:
+                print('failed: %s: %s'%(name, msg))
+            return None
+        with print_lock:
+            print('installed: %s'%name)
+        return ek
+
+    def serial(job):
+        name, mode, argv = job
+        options = getattr(globals().get(mode), 'serial_setup_options', ())
+        return any(x.split('=', 1)[0] in options for x in argv)
+
+    parallel_jobs = [job for job in jobs if not serial(job)]
+    serial_jobs = [job for job in jobs if serial(job)]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        results = list(pool.map(setup_one, parallel_jobs))
+    results.extend(setup_one(job) for job in serial_jobs)
+    results = {job[0]: ek for job, ek in zip(parallel_jobs + serial_jobs, results)}
+
+    # Check once that the kernels are found, instead of once per kernel.
+    found = set(ksm.find_kernel_specs())  # lowercase, like installed names
+    not_found = [name for name, ek in results.items() if ek and ek.name.lower() not in found]
+    if not_found:
+        print('note: not found in the current Jupyter search path:', *not_found)
+    return results
+
+
+def mode_known(mode):
+    return isinstance(globals().get(mode), type) and issubclass(globals()[mode], envkernel)
+
+
+def find_environments(conda_dirs=(), venv_dirs=(), require_ipykernel=True):
+    """Find environments in the given directories, return {path: mode}.
+
+    Conda environments are subdirectories with conda-meta/, venvs are
+    subdirectories with pyvenv.cfg.  Unless require_ipykernel is false,
+    only environments with ipykernel installed are returned."""
+    import glob
+    found = { }
+    for mode, dirs, marker in [('conda', conda_dirs, 'conda-meta'),
+                               ('virtualenv', venv_dirs, 'pyvenv.cfg')]:
+        for dir_ in dirs:
+            try:
+                names = sorted(os.listdir(dir_))
+            except OSError as e:
+                LOG.warning('sync: can not list %s: %s', dir_, e)
+                continue
+            for name in names:
+                path = os.path.abspath(pjoin(dir_, name))
+                if not os.path.exists(pjoin(path, marker)):
+                    continue
+                if require_ipykernel and not glob.glob(
+                        pjoin(path, 'lib', 'python*', 'site-packages', 'ipykernel')):
+                    LOG.debug('sync: no ipykernel in %s', path)
+                    continue
+                found[path] = mode
+    return found
+
+
+def environment_fingerprint(path):
+    """Data which changes when an environment's packages change"""
+    return mtimes([path, pjoin(path, 'conda-meta', 'history'), pjoin(path, 'pyvenv.cfg')])
+
+
+def sync(argv):
+    """Make conda/virtualenv kernels match the environments found.
+
+    A state file records the kernels made by sync and the fingerprints
+    of their environments, so that only new, changed and removed
+    environments are touched.  Returns 1 if any kernel failed."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='envkernel sync')
+    parser.add_argument('--conda-envs-dir', action='append', default=[ ],
+                        help="Directory of conda environments (like conda's envs_dirs), "
+                             "can be given multiple times.  Default $CONDA_ENVS_PATH.")
+    parser.add_argument('--venv-dir', action='append', default=[ ],
+                        help="Directory of virtualenvs, can be given multiple times")
+    parser.add_argument('--conda-name', default='conda-{name}',
+                        help="Kernel name for conda environment {name} (default conda-{name})")
+    parser.add_argument('--venv-name', default='venv-{name}',
+                        help="Kernel name for virtualenv {name} (default venv-{name})")
+    parser.add_argument('--all', action='store_true',
+                        help="Include environments without ipykernel")
+    parser.add_argument('--state',
+                        help="State file (default: in the envkernel cache directory)")
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help="Only print what would be done")
+    parser.add_argument('--jobs', '-j', type=int, default=min(8, os.cpu_count() or 1),
+                        help="Kernels to set up in parallel")
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args, extra_args = parser.parse_known_args(argv)
+    if not args.conda_envs_dir and not args.venv_dir:
+        args.conda_envs_dir = [x for x in os.environ.get('CONDA_ENVS_PATH', '').split(':') if x]
+    if not args.conda_envs_dir and not args.venv_dir:
+        parser.error('no directories to scan, give --conda-envs-dir or --venv-dir')
+    # Separate state for each set of roots and options, since each
+    # describes its own set of kernels.
+    state_file = args.state or pjoin(cache_dir('sync'), cache_key(
+        args.conda_envs_dir, args.venv_dir, args.conda_name, args.venv_name,
+        extra_args, os.getuid()) + '.json')
+    level = LOG.level
+    LOG.setLevel(DEBUG if args.verbose else WARNING)
+    try:
+        # One sync at a time per state file (for overlapping cron runs)
+        with locked(state_file + '.lock'):
+            return _sync(args, extra_args, state_file)
+    finally:
+        LOG.setLevel(level)
+
+
+def _sync(args, extra_args, state_file):
+    import json
+    import re
+    import shutil
+    try:
+        state = json.load(open(state_file))
+    except FileNotFoundError:
+        state = {'version': 1, 'kernels': { }}
+    if state.get('version') != 1:
+        LOG.critical("sync: unknown state file version: %s", state_file)
+        return 1
+
+    envs = find_environments(args.conda_envs_dir, args.venv_dir, require_ipykernel=not args.all)
+    wanted = { }
+    for path, mode in envs.items():
+        fmt = args.conda_name if mode == 'conda' else args.venv_name
+        name = re.sub(r'[^a-zA-Z0-9._-]', '_', fmt.format(name=os.path.basename(path)))
+        if name in wanted:
+            LOG.warning('sync: %s and %s both give kernel name %s, skipping the second',
+                        wanted[name][1], path, name)
+            continue
+        wanted[name] = (mode, path)
+
+    kernels = state['kernels']
+    jobs = [ ]
+    fingerprints = { }
+    for name, (mode, path) in sorted(wanted.items()):
+        argv = ['--name', name, *extra_args, path]
+        # JSON round trip, to compare with what was loaded from the state file
+        fingerprint = json.loads(json.dumps([mode, argv, environment_fingerprint(path)]))
+        old = kernels.get(name)
+        if (old and old['fingerprint'] == fingerprint
+                and os.path.exists(pjoin(old['dir'], 'kernel.json'))):
+            continue
+        fingerprints[name] = fingerprint
+        jobs.append((name, mode, argv))
+    removed = sorted(name for name in kernels if name not in wanted)
+
+    if args.dry_run:
+        for name, mode, argv in jobs:
+            print('%s: %s (%s %s)'%('update' if name in kernels else 'add', name, mode, argv[-1]))
+        for name in removed:
+            print('remove: %s (%s)'%(name, kernels[name]['dir']))
+        return 0
+
+    import jupyter_client.kernelspec
+    ksm = jupyter_client.kernelspec.KernelSpecManager()
+    results = setup_kernels(jobs, ksm, workers=args.jobs) if jobs else { }
+    added = updated = failed = 0
+    for name, ek in results.items():
+        if not ek:
+            failed += 1
+            continue
+        if name in kernels:
+            updated += 1
+        else:
+            added += 1
+        kernels[name] = {'mode': wanted[name][0], 'path': wanted[name][1],
+                         'dir': ek.kernel_dir, 'fingerprint': fingerprints[name]}
+    # Only kernels which sync itself made are ever removed.
+    for name in removed:
+        dir_ = kernels.pop(name)['dir']
+        if os.path.exists(pjoin(dir_, 'kernel.json')):
+            shutil.rmtree(dir_)
+        print('removed: %s'%name)
+    write_atomic(state_file, json.dumps(state, sort_keys=True, indent=1))
+    print('%d added, %d updated, %d removed, %d unchanged, %d failed'%(
+        added, updated, len(removed), len(wanted)-len(jobs), failed))
+    return 1 if failed else 0
+
+
+def stats(argv):
+    """Print p50/p95/max of each run phase per kernel, from the launch journal"""
+    import argparse
+    import json
+    import time
+    parser = argparse.ArgumentParser(prog='envkernel stats')
+    parser.add_argument('--journal', help="Journal file (default: $ENVKERNEL_JOURNAL or the cache)")
+    parser.add_argument('--kernel', action='append', default=[ ],
+                        help="Only these kernels (can be given multiple times)")
+    parser.add_argument('--since', type=float,
+                        help="Only launches in the last this many hours")
+    parser.add_argument('--json', action='store_true', help="Output JSON")
+    args = parser.parse_args(argv)
+    path = args.journal or journal_file()
+    if path is None:
+        print('The launch journal is disabled ($ENVKERNEL_JOURNAL), or the cache '
+              'directory can not be used', file=sys.stderr)
+        return 1
+
+    groups = { }
+    for record in journal_read(path):
+        if args.since is not None and record['time'] < time.time() - args.since*3600:
+            continue
+        # Kernels installed before the journal existed have no name
+        name = record['kernel'] or '%s:%s'%(record['mode'], record['target'])
+        if args.kernel and name not in args.kernel:
+            continue
+        for group in (name, '(all)'):
+            g = groups.setdefault(group, {'mode': record['mode'], 'target': record['target'],
+                                          'count': 0, 'phases': { }})
+            g['count'] += 1
+            for phase, ms in record['phases'].items():
+                g['phases'].setdefault(phase, [ ]).append(ms)
+    for g in groups.values():
+        g['phases'] = {phase: percentiles(times) for phase, times in g['phases'].items()}
+    if '(all)' in groups:
+        groups['(all)'].update(mode='', target='')
+
+    if args.json:
+        print(json.dumps(groups, indent=1, sort_keys=True))
+        return 0
+    if not groups:
+        print('No launches recorded in %s'%path)
+        return 0
+    # Slowest kernels first
+    order = sorted(groups, key=lambda k: (k != '(all)', -groups[k]['phases'].get('total', (0,)*3)[1]))
+    print('%-30s %-8s %6s %8s %8s %8s'%('kernel', 'phase', 'n', 'p50', 'p95', 'max'))
+    for name in order:
+        g = groups[name]
+        for phase, (p50, p95, max_) in g['phases'].items():
+            print('%-30s %-8s %6d %8.1f %8.1f %8.1f'%(name, phase, g['count'], p50, p95, max_))
+    return 0
+
+
+def parse_importtime(lines):
+    """Parse `python -X importtime` output: [(self_us, cumulative_us, depth, module)]"""
+    imports = [ ]
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(parts[0]), int(parts[1]), depth, name.strip()))
+    return imports
+
+
+def profile_start(argv):
+    """Start an installed kernel like Jupyter does, and time its stages"""
+    import argparse
+    import json
+    import queue
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+    import jupyter_client
+    import jupyter_client.kernelspec
+    parser = argparse.ArgumentParser(prog='envkernel profile-start')
+    parser.add_argument('name', help="Name of the installed kernel")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="Seconds to wait for the kernel (default 300)")
+    parser.add_argument('--top', type=int, default=15,
+                        help="Number of slowest imports to show (default 15)")
+    parser.add_argument('--no-importtime', action='store_true',
+                        help="Don't add -X importtime to Python kernels")
+    parser.add_argument('--json', action='store_true', help="Output JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        spec = jupyter_client.kernelspec.KernelSpecManager().get_kernel_spec(args.name)
+    except jupyter_client.kernelspec.NoSuchKernel:
+        print('No such kernel: %s'%args.name, file=sys.stderr)
+        return 1
+    with tempfile.TemporaryDirectory(prefix='envkernel-profile-') as tmpdir:
+        # A copy of the kernel, so that the resource files are found,
+        # with its own journal and import timing.
+        kernel_dir = pjoin(tmpdir, 'kernels', args.name)
+        shutil.copytree(spec.resource_dir, kernel_dir)
+        kernel = json.load(open(pjoin(kernel_dir, 'kernel.json')))
+        journal = pjoin(tmpdir, 'journal.log')
+        kernel.setdefault('env', { })['ENVKERNEL_JOURNAL'] = journal
+        kernel_argv = kernel['argv']
+        # The kernel command is after the last '--' of an envkernel kernel
+        i = max((n+1 for n, x in enumerate(kernel_argv) if x == '--'), default=0)
+        python = i < len(kernel_argv) and os.path.basename(kernel_argv[i]).startswith('python')
+        if python and not args.no_importtime:
+            kernel_argv[i+1:i+1] = ['-X', 'importtime']
+        with open(pjoin(kernel_dir, 'kernel.json'), 'w') as f:
+            json.dump(kernel, f)
+        ksm = jupyter_client.kernelspec.KernelSpecManager(kernel_dirs=[pjoin(tmpdir, 'kernels')])
+        km = jupyter_client.KernelManager(kernel_name=args.name, kernel_spec_manager=ksm)
+
+        stderr_path = pjoin(tmpdir, 'stderr')
+        error = None
+        with open(stderr_path, 'w') as stderr:
+            start = time.perf_counter()
+            km.start_kernel(stdout=subprocess.DEVNULL, stderr=stderr)
+            kc = km.client()
+            kc.start_channels()
+            try:
+                msg_id = kc.kernel_info()
+                while True:
+                    try:
+                        reply = kc.get_shell_msg(timeout=1)
+                    except queue.Empty:
+                        if not km.is_alive():
+                            error = 'the kernel died'
+                            break
+                        if time.perf_counter() - start > args.timeout:
+                            error = 'no reply in %g seconds'%args.timeout
+                            break
+                        continue
+                    if reply['parent_header'].get('msg_id') == msg_id:
+                        break
+                total = (time.perf_counter() - start) * 1000
+            finally:
+                kc.stop_channels()
+                km.shutdown_kernel(now=True)
+        output = open(stderr_path, errors='replace').read().splitlines()
+        records = list(journal_read(journal))
+
+    if error:
+        print('%s: %s.  Its output was:'%(args.name, error), file=sys.stderr)
+        for line in output[-40:]:
+            print('  '+line, file=sys.stderr)
+        return 1
+    stages = [('total', total)]
+    envkernel_ms = 0
+    if records:
+        phases = records[-1]['phases']
+        envkernel_ms = phases.get('total', 0)
+        stages.extend(('envkernel %s (%s)'%(name, records[-1]['mode']), ms)
+                      for name, ms in phases.items())
+    imports = parse_importtime(output)
+    imports_ms = sum(x[1] for x in imports if x[2] == 0) / 1000
+    if imports:
+        stages.append(('kernel imports', imports_ms))
+    stages.append(('other (interpreters, containers, kernel init)',
+                   max(0, total - envkernel_ms - imports_ms)))
+    slowest = sorted(imports, key=lambda x: -x[1])[:args.top]
+
+    if args.json:
+        print(json.dumps({'kernel': args.name, 'stages': dict(stages),
+                          'imports': [{'module': m, 'self_ms': s/1000, 'cumulative_ms': c/1000}
+                                      for s, c, _, m in slowest]}, indent=1))
+        return 0
+    print('%-50s %10s'%('stage', 'ms'))
+    for name, ms in stages:
+        print('%-50s %10.1f'%(name, ms))
+    if not records:
+        print('(no envkernel timings: not an envkernel kernel, or the journal is off)')
+    if slowest:
+        print('')
+        print('%-50s %10s %10s'%('slowest imports', 'cumul. ms', 'self ms'))
+        for self_us, cumulative_us, _, module in slowest:
+            print('%-50s %10.1f %10.1f'%(module, cumulative_us/1000, self_us/1000))
+    return 0
+
+
+# Commands other than modes: envkernel COMMAND [args]
+COMMANDS = {
+    'install-manifest': install_manifest,
+    'sync': sync,
+    'stats': stats,
+    'profile-start': profile_start,
+    }
 
 
 def main(argv=sys.argv):
@@ -663,19 +3354,26 @@ def main(argv=sys.argv):
         print("README.")
         print("")
         print("available modules:", *sorted(all_mods))
+        print("other commands:", *sorted(COMMANDS))
         print("")
         print("General usage: envkernel [envkernel-options] [mode-options]")
         print("")
         print("envkernel-options:")
         print("")
         envkernel(sys.argv).setup()
-        exit(0)
+        sys.exit(0)
+    if mod in COMMANDS:
+        return COMMANDS[mod](argv[2:])
     cls = globals()[mod]
     if len(argv) > 2 and argv[2] == 'run':
-        return cls(argv[3:]).run()
+        LOG.stderr_only()
+        ek = cls(argv[3:])
+        if ek.run_plan():
+            return 0
+        return ek.run()
     else:
         cls(argv[2:]).setup()
         return 0
 
 if __name__ == '__main__':
-    exit(main())
+    sys.exit(main())
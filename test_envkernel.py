@@ -1,9 +1,12 @@
+import glob
 import json
 import logging
 import os
 from os.path import join as pjoin
 import pytest
 import shlex
+import shutil
+import socket
 import subprocess
 import sys
 import tempfile
@@ -26,7 +29,7 @@ TEST_CONNECTION_FILE = """\
   "kernel_name": ""
 }
 """
-ALL_MODULES = ["conda", "virtualenv", "venv", "lmod", "docker", "singularity"]
+ALL_MODULES = ["conda", "virtualenv", "venv", "lmod", "spack", "docker", "singularity"]
 
 
 def install(d, argv, name='testkernel'):
@@ -49,21 +52,22 @@ def get(d, name):
         'k': envkernel.split_doubledash(kernel['argv'])[1],
         }
 
-def run(d, kern, execvp=lambda _argv0, argv: 0):
+def run(d, kern, execvp=lambda _argv0, argv: 0, connection=TEST_CONNECTION_FILE):
     """Start envkernel in "run" mode to see if it can run successfully.
     """
     connection_file = pjoin(d, 'connection.json')
-    open(connection_file, 'w').write(TEST_CONNECTION_FILE)
+    open(connection_file, 'w').write(connection)
     # Do basic tests
     argv = kern['kernel']['argv']
     clsname = argv[1]
     assert argv[2] == 'run'
-    # Replace connecton file
+    # Replace connecton file and resource dir, like jupyter_client does
     argv = [ replace_conn_file(x, connection_file) for x in argv ]
+    argv = [ x.replace('{resource_dir}', kern['dir']) for x in argv ]
     # Setup object, override the execvp for the function, run.
     ek = getattr(envkernel, clsname)(argv[3:])
     ek.execvp = execvp
-    ek.run()
+    ek.run_plan() or ek.run()
 
 @pytest.fixture(scope='function')
 def d():
@@ -71,6 +75,13 @@ def d():
     with tempfile.TemporaryDirectory() as dir_:
         yield dir_
 
+@pytest.fixture(autouse=True)
+def journal(tmp_path, monkeypatch):
+    """Write the launch journal of run mode to a temporary file"""
+    path = str(tmp_path/'launches.log')
+    monkeypatch.setenv('ENVKERNEL_JOURNAL', path)
+    return path
+
 def replace_conn_file(arg, connection_file):
     if isinstance(arg, list):
         return [ replace_conn_file(x, connection_file) for x in arg ]
@@ -229,6 +240,313 @@ def test_recursive_run(d):
     run(d, kern2, test_exec)
 
 
+def test_chain(d, journal, monkeypatch):
+    monkeypatch.setenv('JUPYTER_PATH', pjoin(d, 'share/jupyter'))
+    for var in ('PATH', 'CPATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH'):
+        monkeypatch.setenv(var, os.environ.get(var, ''))
+    for env in ('conda-env', 'venv'):
+        os.makedirs(pjoin(d, env, 'bin'))
+    install(d, "conda %s"%pjoin(d, 'conda-env'), name='inner')
+    kern = install(d, "virtualenv --chain --kernel-template=inner %s"%pjoin(d, 'venv'), name='outer')
+    assert kern['kernel']['env']['ENVKERNEL_CHAIN'] == '1'
+    calls = [ ]
+    def test_exec(_file, argv):
+        calls.append(argv)
+    # Without ENVKERNEL_CHAIN (set by Jupyter from kernel.json), the
+    # inner envkernel is started normally.
+    run(d, kern, test_exec)
+    assert calls[-1][1:3] == ['conda', 'run']
+    # With it, both layers are applied here, and only the kernel is started.
+    monkeypatch.setenv('ENVKERNEL_CHAIN', '1')
+    run(d, kern, test_exec)
+    assert calls[-1][:3] == ['python', '-m', 'ipykernel_launcher']
+    path = os.environ['PATH'].split(':')
+    assert path[:2] == [pjoin(d, 'conda-env', 'bin'), pjoin(d, 'venv', 'bin')]
+    record = list(envkernel.journal_read(journal))[-1]
+    assert record['mode'] == 'virtualenv+conda'
+    assert record['target'] == '%s + %s'%(pjoin(d, 'venv'), pjoin(d, 'conda-env'))
+
+def test_isolate(d):
+    kern = install(d, "conda --isolate TESTTARGET")
+    assert kern['ek'][:4] == [sys.executable, '-I', '-S', '-c']
+    assert kern['ek'][5:7] == ['conda', 'run']
+
+def test_if_changed(d):
+    kern = install(d, "lmod --if-changed --display-name=A TESTTARGET")
+    kernels_dir = os.path.dirname(kern['dir'])
+    st = os.stat(pjoin(kern['dir'], 'kernel.json'))
+    # Same kernel: nothing is touched
+    kern = install(d, "lmod --if-changed --display-name=A TESTTARGET")
+    st2 = os.stat(pjoin(kern['dir'], 'kernel.json'))
+    assert (st.st_ino, st.st_mtime_ns) == (st2.st_ino, st2.st_mtime_ns)
+    # Changed: replaced, with no temporary directories left over
+    kern = install(d, "lmod --if-changed --display-name=B TESTTARGET")
+    assert kern['kernel']['display_name'] == 'B'
+    assert os.listdir(kernels_dir) == ['testkernel']
+    # A missing file is noticed, too
+    os.unlink(pjoin(kern['dir'], 'kernel.json'))
+    kern = install(d, "lmod --if-changed --display-name=B TESTTARGET")
+    assert kern['kernel']['display_name'] == 'B'
+    # And a changed one
+    open(pjoin(kern['dir'], 'kernel.json'), 'a').write(' ')
+    kern = install(d, "lmod --if-changed --display-name=B TESTTARGET")
+    assert open(pjoin(kern['dir'], 'kernel.json')).read().endswith('}')
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="renameat2 is Linux only")
+def test_rename_exchange(d):
+    os.makedirs(pjoin(d, 'a', 'x'))
+    os.makedirs(pjoin(d, 'b', 'y'))
+    assert envkernel.rename_exchange(pjoin(d, 'a'), pjoin(d, 'b'))
+    assert os.listdir(pjoin(d, 'a')) == ['y']
+    assert os.listdir(pjoin(d, 'b')) == ['x']
+    with pytest.raises(FileNotFoundError):
+        envkernel.rename_exchange(pjoin(d, 'a'), pjoin(d, 'c'))
+
+def test_if_changed_validates(d):
+    # Validated like without --if-changed, before anything is written
+    with pytest.raises(ValueError, match='Invalid kernel name'):
+        install(d, "lmod --if-changed TESTTARGET", name='bad name/../x')
+    with pytest.raises(ValueError, match='both user and prefix'):
+        install(d, "lmod --if-changed --user TESTTARGET")
+    assert os.listdir(d) == [ ]
+
+def test_link_resources(d):
+    k1 = install(d, "conda --link-resources=hardlink TESTTARGET", name='k1')
+    k2 = install(d, "lmod --link-resources=hardlink --if-changed TESTTARGET", name='k2')
+    logos = [x for x in os.listdir(k1['dir']) if x.startswith('logo-')]
+    assert logos
+    for logo in logos:
+        st1, st2 = os.stat(pjoin(k1['dir'], logo)), os.stat(pjoin(k2['dir'], logo))
+        assert st1.st_ino == st2.st_ino
+        assert st1.st_nlink == 3
+    store = pjoin(os.path.dirname(k1['dir']), '.envkernel-resources')
+    assert len(os.listdir(store)) == len(logos)
+    # Symlinks, to the same store
+    k3 = install(d, "conda --link-resources=symlink TESTTARGET", name='k3')
+    for logo in logos:
+        assert os.path.islink(pjoin(k3['dir'], logo))
+        assert os.path.samefile(pjoin(k3['dir'], logo), pjoin(k1['dir'], logo))
+    # The store directory is not a kernel
+    import jupyter_client.kernelspec
+    ksm = jupyter_client.kernelspec.KernelSpecManager(kernel_dirs=[os.path.dirname(k1['dir'])])
+    assert set(ksm.find_kernel_specs()) - {'python3'} == {'k1', 'k2', 'k3'}
+
+def test_journal(d, journal, capsys, monkeypatch):
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    kern = install(d, "virtualenv %s"%pjoin(d, 'env'), name='k-venv')
+    assert kern['kernel']['env']['ENVKERNEL_NAME'] == 'k-venv'
+    for _ in range(3):
+        monkeypatch.setenv('ENVKERNEL_NAME', 'k-venv')
+        run(d, kern)
+    records = list(envkernel.journal_read(journal))
+    assert len(records) == 3
+    assert records[0]['mode'] == 'virtualenv'
+    assert records[0]['kernel'] == 'k-venv'
+    assert records[0]['target'] == pjoin(d, 'env')
+    assert set(records[0]['phases']) == {'parse', 'prepare', 'total'}
+
+    assert envkernel.main(['envkernel', 'stats', '--json']) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['k-venv']['count'] == 3
+    assert len(stats['k-venv']['phases']['total']) == 3
+    assert envkernel.main(['envkernel', 'stats']) == 0
+    assert 'k-venv' in capsys.readouterr().out
+
+    # Rotation
+    monkeypatch.setattr(envkernel, 'JOURNAL_MAX_SIZE', 1000)
+    for i in range(50):
+        envkernel.journal_write(['conda', 'k', 'target%d'%i], [('total', 1)])
+        # The record which caused the rotation is in the new file
+        assert os.path.getsize(journal) <= 1000
+        if os.path.exists(journal+'.1'):
+            assert os.path.getsize(journal+'.1') <= 1000
+    assert [x['target'] for x in envkernel.journal_read(journal)][-1] == 'target49'
+    # Another start rotating at the same time: the record is still written
+    while os.path.getsize(journal) < 950:
+        envkernel.journal_write(['conda', 'k', 'target'], [('total', 1)])
+    def replace(src, dst):
+        raise FileNotFoundError(src)
+    monkeypatch.setattr(os, 'replace', replace)
+    envkernel.journal_write(['conda', 'k', 'raced'], [('total', 1)])
+    assert [x['target'] for x in envkernel.journal_read(journal)][-1] == 'raced'
+
+def test_journal_unusable_cache(d, monkeypatch):
+    """An unusable cache directory does not stop kernels from starting"""
+    open(pjoin(d, 'file'), 'w').close()
+    monkeypatch.delenv('ENVKERNEL_JOURNAL')
+    monkeypatch.delenv('ENVKERNEL_CACHE_DIR', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', pjoin(d, 'file', 'cache'))
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    kern = install(d, "virtualenv %s"%pjoin(d, 'env'))
+    started = [ ]
+    run(d, kern, lambda _file, argv: started.append(argv))
+    assert started
+    assert envkernel.journal_file() is None
+
+def test_parse_importtime():
+    imports = envkernel.parse_importtime([
+        'import time: self [us] | cumulative | imported package',
+        'import time:       100 |        100 |   b',
+        'import time:        50 |        150 | a',
+        'other output',
+        ])
+    assert imports == [(100, 100, 1, 'b'), (50, 150, 0, 'a')]
+
+def test_profile_start(d, capsys, monkeypatch):
+    monkeypatch.setenv('JUPYTER_PATH', pjoin(d, 'share/jupyter'))
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    install(d, "virtualenv --isolate --python=SELF %s"%pjoin(d, 'env'), name='k-prof')
+    capsys.readouterr()
+    assert envkernel.main(['envkernel', 'profile-start', '--json', 'k-prof']) == 0
+    profile = json.loads(capsys.readouterr().out)
+    assert profile['stages']['envkernel total (virtualenv)'] > 0
+    assert profile['stages']['kernel imports'] > 0
+    assert any(x['module'] == 'ipykernel.kernelapp' for x in profile['imports'])
+    assert envkernel.main(['envkernel', 'profile-start', 'k-missing']) == 1
+
+def test_install_manifest(d, capsys):
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    manifest = pjoin(d, 'kernels.json')
+    json.dump({'defaults': {'prefix': d},
+               'kernels': [
+                   {'mode': 'conda', 'name': 'k-conda', 'display-name': 'C', 'args': [pjoin(d, 'env')]},
+                   {'mode': 'lmod', 'name': 'k-lmod', 'env': {'AAA': 'BBB'}, 'args': 'mod1 mod2'},
+                   {'mode': 'docker', 'name': 'k-docker', 'pwd': True, 'args': ['IMAGE']},
+                   {'mode': 'nosuchmode', 'name': 'k-bad'},
+                   {'mode': 'conda', 'name': 'k-noargs'},
+                   ]}, open(manifest, 'w'))
+    assert envkernel.main(['envkernel', 'install-manifest', manifest]) == 1
+    out = capsys.readouterr().out
+    assert 'failed: k-bad: unknown mode nosuchmode' in out
+    assert 'failed: k-noargs: setup failed' in out
+    assert '3 kernels installed, 2 failed' in out
+    kern = get(d, 'k-conda')
+    assert kern['kernel']['display_name'] == 'C'
+    assert kern['ek'][-1] == pjoin(d, 'env')
+    kern = get(d, 'k-lmod')
+    assert kern['kernel']['env']['AAA'] == 'BBB'
+    assert kern['ek'][-2:] == ['mod1', 'mod2']
+    assert '--pwd' in get(d, 'k-docker')['ek']
+
+    # TOML, with extra options from the command line
+    manifest = pjoin(d, 'kernels.toml')
+    open(manifest, 'w').write(
+        '[[kernels]]\nmode = "virtualenv"\nname = "k-venv"\nargs = ["%s"]\n'%pjoin(d, 'env'))
+    pytest.importorskip('tomllib')
+    assert envkernel.main(['envkernel', 'install-manifest', manifest, '--prefix', d,
+                           '--display-name=V']) == 0
+    assert get(d, 'k-venv')['kernel']['display_name'] == 'V'
+
+def test_install_manifest_name_case_and_verbose(d, capsys, monkeypatch):
+    import threading
+    monkeypatch.setenv('JUPYTER_PATH', pjoin(d, 'share/jupyter'))
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    manifest = pjoin(d, 'kernels.json')
+    json.dump({'defaults': {'prefix': d},
+               'kernels': [
+                   {'mode': 'conda', 'name': 'K-Mixed', 'args': [pjoin(d, 'env')]},
+                   {'mode': 'conda', 'name': 'k-verbose', 'verbose': True, 'args': [pjoin(d, 'env')]},
+                   ]}, open(manifest, 'w'))
+    # The log level is only set by install-manifest itself, not by the
+    # kernels set up in parallel.
+    threads = [ ]
+    set_level = envkernel.LOG.setLevel
+    monkeypatch.setattr(envkernel.LOG, 'setLevel',
+                        lambda level: threads.append(threading.current_thread()) or set_level(level))
+    assert envkernel.main(['envkernel', 'install-manifest', manifest]) == 0
+    assert set(threads) == {threading.main_thread()}
+    # Installed names are lowercase, and found
+    assert 'not found' not in capsys.readouterr().out
+    assert get(d, 'k-mixed')
+
+def make_env(path, marker, ipykernel=True):
+    os.makedirs(pjoin(path, 'bin'))
+    if marker == 'conda-meta':
+        os.makedirs(pjoin(path, 'conda-meta'))
+        open(pjoin(path, 'conda-meta', 'history'), 'w').close()
+    else:
+        open(pjoin(path, marker), 'w').close()
+    if ipykernel:
+        os.makedirs(pjoin(path, 'lib', 'python3.9', 'site-packages', 'ipykernel'))
+
+def test_sync(d, capsys):
+    make_env(pjoin(d, 'envs', 'env1'), 'conda-meta')
+    make_env(pjoin(d, 'envs', 'noipy'), 'conda-meta', ipykernel=False)
+    os.makedirs(pjoin(d, 'envs', 'notanenv'))
+    make_env(pjoin(d, 'venvs', 'v1'), 'pyvenv.cfg')
+    state = pjoin(d, 'state.json')
+    cmd = ['envkernel', 'sync', '--conda-envs-dir', pjoin(d, 'envs'),
+           '--venv-dir', pjoin(d, 'venvs'), '--state', state, '--prefix', d]
+    assert envkernel.main(cmd) == 0
+    assert '2 added, 0 updated, 0 removed, 0 unchanged, 0 failed' in capsys.readouterr().out
+    kern = get(d, 'conda-env1')
+    assert kern['ek'][1:3] == ['conda', 'run']
+    assert kern['ek'][-1] == pjoin(d, 'envs', 'env1')
+    assert get(d, 'venv-v1')['ek'][1:3] == ['virtualenv', 'run']
+    assert not os.path.exists(pjoin(d, 'share/jupyter/kernels/conda-noipy'))
+    # Nothing changed
+    mtime = os.stat(pjoin(kern['dir'], 'kernel.json')).st_mtime
+    assert envkernel.main(cmd) == 0
+    assert '0 added, 0 updated, 0 removed, 2 unchanged' in capsys.readouterr().out
+    assert os.stat(pjoin(kern['dir'], 'kernel.json')).st_mtime == mtime
+    # Changed environment, and removed environment
+    os.utime(pjoin(d, 'envs', 'env1', 'conda-meta', 'history'), (0, 0))
+    shutil.rmtree(pjoin(d, 'venvs', 'v1'))
+    assert envkernel.main(cmd + ['-n']) == 0
+    out = capsys.readouterr().out
+    assert 'update: conda-env1' in out
+    assert 'remove: venv-v1' in out
+    assert envkernel.main(cmd) == 0
+    assert '0 added, 1 updated, 1 removed, 0 unchanged' in capsys.readouterr().out
+    assert not os.path.exists(pjoin(d, 'share/jupyter/kernels/venv-v1'))
+    assert os.path.exists(pjoin(d, 'share/jupyter/kernels/conda-env1'))
+
+# Modules which the run mode of the simple modes should not need.
+# (argparse itself imports shutil.)
+RUN_UNNEEDED_MODULES = {'logging', 'json', 'subprocess', 'tempfile', 'glob',
+                        'copy', 'textwrap', 'jupyter_client'}
+# Allowed overhead of `envkernel virtualenv run` (seconds), on top of
+# starting a bare `python -I -S`.
+RUN_STARTUP_BUDGET = float(os.environ.get('ENVKERNEL_STARTUP_BUDGET', 0.1))
+
+def test_run_startup_budget(d):
+    """The run mode is in the path of every kernel start, keep it fast."""
+    import statistics
+    import time
+    PATH = pjoin(d, 'test-venv')
+    os.makedirs(pjoin(PATH, 'bin'))
+    kern = install(d, "virtualenv --isolate %s"%PATH)
+    # Replace the resource dir like jupyter_client does, so that the
+    # launch plan is used.
+    cmd = [x.replace('{resource_dir}', kern['dir']) for x in kern['ek']] + ['--', 'true']
+    # Which modules are imported (check with execvp replaced)
+    code = ("import sys; sys.path.insert(0, %r); import envkernel; "
+            "envkernel.envkernel.execvp = staticmethod(lambda f, a: print(*sys.modules)); "
+            "envkernel.main()")%os.path.dirname(envkernel.__file__)
+    def imported():
+        out = subprocess.check_output(cmd[:4] + [code] + cmd[5:], stderr=subprocess.DEVNULL)
+        return set(out.decode().split())
+    modules = imported()
+    assert 'envkernel' in modules  # make sure it worked
+    assert not (modules & (RUN_UNNEEDED_MODULES | {'argparse'}))
+    # Time it
+    def timeit(cmd):
+        times = [ ]
+        for _ in range(7):
+            start = time.perf_counter()
+            subprocess.check_call(cmd, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+    overhead = timeit(cmd) - timeit(cmd[:3] + ['-c', 'pass'])
+    assert overhead < RUN_STARTUP_BUDGET
+    # Without the plan, the normal run mode (with argparse) is used
+    for fname in os.listdir(kern['dir']):
+        if fname.startswith(envkernel.envkernel.plan_prefix):
+            os.unlink(pjoin(kern['dir'], fname))
+    modules = imported()
+    assert 'argparse' in modules
+    assert not (modules & RUN_UNNEEDED_MODULES)
+
 
 # Languages
 @all_modes()
@@ -318,6 +636,216 @@ def test_run_conda(d):
     kern = install(d, "conda %s"%PATH)
     run(d, kern, test_exec)
 
+def test_clean_path():
+    assert envkernel.path_join('/a', '/b:/a/:/c', None, '/b') == '/a:/b:/c'
+    assert envkernel.clean_path('/a::/a:/b/../a:') == '/a:'
+    assert envkernel.clean_path('%s:/nonexistent:/'%os.getcwd(), prune=True) == os.getcwd()+':/'
+
+def test_run_conda_paths(d, monkeypatch):
+    PATH = pjoin(d, 'test-conda')
+    os.makedirs(pjoin(PATH, 'bin'))
+    os.makedirs(pjoin(PATH, 'lib'))
+    open(pjoin(PATH, 'lib', 'libtest.so.1'), 'w').close()
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    monkeypatch.setenv('PATH', pjoin(PATH, 'bin')+':/nonexistent:'+os.environ['PATH'])
+    monkeypatch.setenv('LD_LIBRARY_PATH', '/nonexistent')
+    def test_exec(_file, _args):
+        PATH_ = os.environ['PATH'].split(':')
+        assert PATH_.count(pjoin(PATH, 'bin')) == 1
+        assert '/nonexistent' not in PATH_
+        libs = os.environ['LD_LIBRARY_PATH']
+        assert libs.startswith(pjoin(d, 'cache', 'lib-cache'))
+        assert os.path.realpath(pjoin(libs, 'libtest.so.1')) == os.path.realpath(pjoin(PATH, 'lib', 'libtest.so.1'))
+    kern = install(d, "conda --prune-paths --lib-cache %s"%PATH)
+    run(d, kern, test_exec)
+    assert len(os.listdir(pjoin(d, 'cache', 'lib-cache'))) == 1
+    # A changed library directory makes a new link directory
+    open(pjoin(PATH, 'lib', 'libtest2.so'), 'w').close()
+    run(d, kern, test_exec)
+    assert len(os.listdir(pjoin(d, 'cache', 'lib-cache'))) == 1
+    assert os.path.lexists(pjoin(os.environ['LD_LIBRARY_PATH'], 'libtest2.so'))
+
+def test_run_lmod_dedup(d, monkeypatch):
+    fake_lmod(d, monkeypatch)
+    monkeypatch.setenv('PATH', '/a:/b:/a:'+os.environ['PATH'])
+    def test_exec(_file, argv):
+        assert os.environ['PATH'].startswith('/a:/b:')
+        assert os.environ['PATH'].count('/a:') == 1
+    kern = install(d, "lmod MOD1")
+    run(d, kern, test_exec)
+
+def test_compile(d, monkeypatch):
+    PATH = pjoin(d, 'venv')
+    subprocess.check_call([sys.executable, '-m', 'venv', '--without-pip', PATH])
+    site_packages = glob.glob(pjoin(PATH, 'lib', 'python*', 'site-packages'))[0]
+    open(pjoin(site_packages, 'testmod.py'), 'w').write('x = 1\n')
+    install(d, "virtualenv --compile %s"%PATH)
+    assert glob.glob(pjoin(site_packages, '__pycache__', 'testmod.*.pyc'))
+    # A read-only environment is compiled into the user's cache
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    access = os.access
+    monkeypatch.setattr(os, 'access', lambda p, m: p != pjoin(PATH, 'lib') and access(p, m))
+    kern = install(d, "virtualenv --compile %s"%PATH)
+    assert glob.glob(pjoin(d, 'cache', 'pycache', site_packages.lstrip('/'), 'testmod.*.pyc'))
+    def test_exec(_file, argv):
+        assert os.environ['PYTHONPYCACHEPREFIX'] == pjoin(d, 'cache', 'pycache')
+    with monkeypatch.context() as m:
+        m.delenv('PYTHONPYCACHEPREFIX', raising=False)
+        run(d, kern, test_exec)
+
+@all_modes(['conda', 'virtualenv'])
+def test_run_stage(d, mode, monkeypatch):
+    monkeypatch.setenv('ENVKERNEL_STAGE_DIR', pjoin(d, 'stage'))
+    monkeypatch.setenv('PATH', os.environ['PATH'])  # restored after run() changes it
+    PATH = pjoin(d, 'env')
+    os.makedirs(pjoin(PATH, 'bin'))
+    os.makedirs(pjoin(PATH, 'lib', 'python3.9', 'site-packages'))
+    open(pjoin(PATH, 'lib', 'python3.9', 'site-packages', 'a.py'), 'w').write('a')
+    os.symlink('a.py', pjoin(PATH, 'lib', 'python3.9', 'site-packages', 'b.py'))
+    staged = [ ]
+    def test_exec(_file, argv):
+        local = [x for x in os.environ['PATH'].split(':') if x.startswith(pjoin(d, 'stage'))][0]
+        assert os.path.basename(os.path.dirname(local)) == 'env'
+        staged.append(os.path.dirname(local))
+    kern = install(d, "%s --stage %s"%(mode, PATH))
+    assert not any(x.startswith('--plan') for x in kern['ek'])
+    run(d, kern, test_exec)
+    run(d, kern, test_exec)
+    assert staged[0] == staged[1]
+    site_packages = pjoin(staged[0], 'lib', 'python3.9', 'site-packages')
+    assert open(pjoin(site_packages, 'a.py')).read() == 'a'
+    assert os.readlink(pjoin(site_packages, 'b.py')) == 'a.py'
+    # Installing a package makes a new version, reusing unchanged files
+    open(pjoin(PATH, 'lib', 'python3.9', 'site-packages', 'c.py'), 'w').write('c')
+    os.utime(pjoin(PATH, 'lib', 'python3.9', 'site-packages'), (0, 0))
+    run(d, kern, test_exec)
+    assert staged[2] != staged[0]
+    new_site_packages = pjoin(staged[2], 'lib', 'python3.9', 'site-packages')
+    assert os.path.exists(pjoin(new_site_packages, 'c.py'))
+    assert os.path.samefile(pjoin(new_site_packages, 'a.py'), pjoin(site_packages, 'a.py'))
+    # The old version is in use (by this process), so it is kept
+    assert os.path.exists(site_packages)
+    # Unused versions are evicted to keep under the size limit
+    for pid in glob.glob(pjoin(d, 'stage', 'environments', '*', '*', 'pids', '*')):
+        os.unlink(pid)
+    os.makedirs(pjoin(d, 'env2', 'bin'))
+    open(pjoin(d, 'env2', 'bin', 'x'), 'w').write('xx')
+    env2 = envkernel.stage_environment(pjoin(d, 'env2'), pjoin(d, 'stage', 'environments'),
+                                       'fingerprint', max_size=3/2**20)
+    assert glob.glob(pjoin(d, 'stage', 'environments', '*', '*', 'size')) \
+        == [pjoin(os.path.dirname(env2), 'size')]
+
+def test_stage_environment_lock(d):
+    import threading
+    os.makedirs(pjoin(d, 'env', 'bin'))
+    directory = pjoin(d, 'stage')
+    os.mkdir(directory, 0o700)
+    dest = envkernel.stage_environment(pjoin(d, 'env'), directory, 'fp')
+    pids = pjoin(os.path.dirname(dest), 'pids')
+    os.unlink(pjoin(pids, str(os.getpid())))
+    # While versions are being removed (the lock is held exclusively),
+    # a start waits before registering as a user.
+    results = [ ]
+    with envkernel.locked(pjoin(directory, '.lock')):
+        t = threading.Thread(target=lambda: results.append(
+            envkernel.stage_environment(pjoin(d, 'env'), directory, 'fp')))
+        t.start()
+        t.join(0.3)
+        assert t.is_alive()
+        assert os.listdir(pids) == [ ]
+    t.join()
+    assert results == [dest]
+    assert os.listdir(pids) == [str(os.getpid())]
+
+def test_run_stage_not_private(d, monkeypatch):
+    monkeypatch.setenv('PATH', os.environ['PATH'])
+    PATH = pjoin(d, 'env')
+    os.makedirs(pjoin(PATH, 'bin'))
+    kern = install(d, "virtualenv --stage %s"%PATH)
+    def test_exec(_file, argv):
+        assert os.environ['PATH'].split(':')[0] == pjoin(PATH, 'bin')
+    # Made by someone else first (here: not mode 0700), or a symlink
+    os.mkdir(pjoin(d, 'stage'), 0o755)
+    os.chmod(pjoin(d, 'stage'), 0o755)
+    monkeypatch.setenv('ENVKERNEL_STAGE_DIR', pjoin(d, 'stage'))
+    run(d, kern, test_exec)
+    assert os.listdir(pjoin(d, 'stage')) == [ ]
+    os.mkdir(pjoin(d, 'elsewhere'), 0o700)
+    os.symlink(pjoin(d, 'elsewhere'), pjoin(d, 'stage-link'))
+    monkeypatch.setenv('ENVKERNEL_STAGE_DIR', pjoin(d, 'stage-link'))
+    run(d, kern, test_exec)
+    assert os.listdir(pjoin(d, 'elsewhere')) == [ ]
+    # Also checked below the stage dir
+    monkeypatch.setenv('ENVKERNEL_STAGE_DIR', pjoin(d, 'stage2'))
+    os.makedirs(pjoin(d, 'stage2', 'environments'), 0o700)
+    os.chmod(pjoin(d, 'stage2', 'environments'), 0o777)
+    run(d, kern, test_exec)
+    assert os.listdir(pjoin(d, 'stage2', 'environments')) == [ ]
+
+@all_modes(['conda', 'virtualenv'])
+def test_run_plan(d, mode, monkeypatch):
+    PATH = pjoin(d, 'test-env')
+    os.makedirs(pjoin(PATH, 'bin'))
+    for var in ('PATH', 'CPATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH'):
+        monkeypatch.setenv(var, os.environ.get(var, ''))
+    monkeypatch.setenv('PYTHONHOME', '/nonexistent')
+    kern = install(d, "%s %s"%(mode, PATH))
+    plan_arg = kern['ek'][3]
+    assert plan_arg.startswith('--plan={resource_dir}/envkernel-plan-')
+    plan = plan_arg.replace('--plan={resource_dir}', kern['dir'])
+    assert open(plan).readline() == 'envkernel-plan\t1\n'
+    def test_exec(_file, argv):
+        assert os.environ['PATH'].split(':')[0] == pjoin(PATH, 'bin')
+        assert ('PYTHONHOME' in os.environ) == (mode == 'conda')
+        calls.append(argv)
+    # The plan is used, not the arguments
+    calls = [ ]
+    with monkeypatch.context() as m:
+        m.setattr(envkernel.conda, 'run', None)
+        run(d, kern, test_exec)
+    assert calls[0][:2] == kern['k'][:2]
+    # Unknown plan version, or no plan (older kernels): arguments are used
+    monkeypatch.setenv('PYTHONHOME', '/nonexistent')
+    open(plan, 'w').write('envkernel-plan\t999\n')
+    run(d, kern, test_exec)
+    kern['kernel']['argv'].remove(plan_arg)
+    run(d, kern, test_exec)
+    assert len(calls) == 3
+
+def test_run_conda_activate(d, monkeypatch):
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    PATH = pjoin(d, 'test-conda')
+    os.makedirs(pjoin(PATH, 'bin'))
+    os.makedirs(pjoin(PATH, 'conda-meta'))
+    os.makedirs(pjoin(PATH, 'etc/conda/activate.d'))
+    open(pjoin(PATH, 'conda-meta/history'), 'w').close()
+    open(pjoin(PATH, 'conda-meta/state'), 'w').write('{"env_vars": {"TEST_VAR": "1"}}')
+    open(pjoin(PATH, 'etc/conda/activate.d/test.sh'), 'w').write(
+        'echo ran >> %s/calls\n'
+        'echo "this is not the environment"\n'
+        'export TEST_ACTIVATE="$CONDA_PREFIX"\n'%d)
+    for var in ('TEST_ACTIVATE', 'TEST_VAR', 'CONDA_PREFIX'):
+        monkeypatch.delenv(var, raising=False)
+
+    def test_exec(_file, _args):
+        assert os.environ['CONDA_PREFIX'] == PATH
+        assert os.environ['TEST_ACTIVATE'] == PATH
+        assert os.environ['TEST_VAR'] == '1'
+        assert pjoin(PATH, 'bin') in os.environ['PATH'].split(':')
+    kern = install(d, "conda --activate %s"%PATH)
+    environ = dict(os.environ)
+    run(d, kern, test_exec)
+    os.environ.clear()
+    os.environ.update(environ)
+    run(d, kern, test_exec)
+    assert len(open(pjoin(d, 'calls')).readlines()) == 1
+    # Changes to the environment invalidate the cache
+    os.environ.clear()
+    os.environ.update(environ)
+    os.utime(pjoin(PATH, 'conda-meta/history'), (0, 0))
+    run(d, kern, test_exec)
+    assert len(open(pjoin(d, 'calls')).readlines()) == 2
+
 def test_run_venv(d):
     PATH = pjoin(d, 'test-venv')
     os.mkdir(PATH)
@@ -331,6 +859,225 @@ def test_run_venv(d):
 # Requires lmod installed... and a module to exist
 #def test_run_lmod(d):
 
+def fake_lmod(d, monkeypatch, path=False):
+    """Install a stand-in for `$LMOD_PKG/libexec/lmod`.
+
+    Each call is logged to $LMOD_PKG/calls, and loading sets
+    TEST_LMOD to the list of modules (and with path=True, prepends
+    $LMOD_PKG/bin to PATH)."""
+    LMOD_PKG = pjoin(d, 'lmod')
+    os.makedirs(pjoin(LMOD_PKG, 'libexec'))
+    script = pjoin(LMOD_PKG, 'libexec', 'lmod')
+    open(script, 'w').write(
+        '#!/bin/sh\n'
+        'echo "$@" >> "$LMOD_PKG/calls"\n'
+        'shift\n'
+        'echo "os.environ[\'TEST_LMOD\'] = \'$*\'"\n'
+        + ('echo "os.environ[\'PATH\'] = \'$LMOD_PKG/bin:\' + os.environ[\'PATH\']"\n'
+           if path else ''))
+    os.chmod(script, 0o755)
+    monkeypatch.setenv('LMOD_PKG', LMOD_PKG)
+    os.mkdir(pjoin(d, 'modules'))
+    monkeypatch.setenv('MODULEPATH', pjoin(d, 'modules'))
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    monkeypatch.delenv('TEST_LMOD', raising=False)
+    return lambda: open(pjoin(LMOD_PKG, 'calls')).read().splitlines()
+
+def test_run_lmod(d, monkeypatch):
+    calls = fake_lmod(d, monkeypatch)
+    def test_exec(_file, argv):
+        assert os.environ['TEST_LMOD'] == 'load MOD1 MOD2'
+    kern = install(d, "lmod MOD1 MOD2")
+    run(d, kern, test_exec)
+    assert calls() == ['python load MOD1 MOD2']
+
+def test_run_lmod_cache(d, monkeypatch):
+    calls = fake_lmod(d, monkeypatch)
+    def test_exec(_file, argv):
+        assert os.environ['TEST_LMOD'] == 'load MOD1'
+    kern = install(d, "lmod --cache MOD1")
+    run(d, kern, test_exec)
+    del os.environ['TEST_LMOD']
+    run(d, kern, test_exec)
+    assert calls() == ['python load MOD1']
+    # Changing the module tree invalidates the cache
+    del os.environ['TEST_LMOD']
+    os.utime(pjoin(d, 'modules'), (0, 0))
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+
+def test_lmod_freeze(d, monkeypatch):
+    calls = fake_lmod(d, monkeypatch)
+    kern = install(d, "lmod --freeze --purge MOD1")
+    assert glob.glob(pjoin(kern['dir'], envkernel.lmod.frozen_prefix+'*.json'))
+    assert 'TEST_LMOD' not in os.environ
+    assert calls() == ['python purge', 'python load MOD1']
+    def test_exec(_file, argv):
+        assert os.environ['TEST_LMOD'] == 'load MOD1'
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+    # Falls back to a live load when the module tree changes
+    del os.environ['TEST_LMOD']
+    os.utime(pjoin(d, 'modules'), (0, 0))
+    run(d, kern, test_exec)
+    assert len(calls()) == 4
+
+def test_lmod_freeze_stacked(d, monkeypatch):
+    monkeypatch.setenv('JUPYTER_PATH', pjoin(d, 'share/jupyter'))
+    calls = fake_lmod(d, monkeypatch)
+    install(d, "lmod --freeze --purge MOD1", name='inner')
+    kern = install(d, "lmod --freeze --purge --kernel-template=inner MOD2", name='outer')
+    assert len(calls()) == 4
+    # Each layer's frozen environment is kept, not overwritten by the other
+    frozen = [x.replace('--frozen={resource_dir}', kern['dir'])
+              for x in kern['kernel']['argv'] if x.startswith('--frozen=')]
+    assert [json.load(open(x))['modules'] for x in frozen] == [['MOD2'], ['MOD1']]
+
+def test_lmod_freeze_no_lmod(d, monkeypatch):
+    monkeypatch.delenv('LMOD_PKG', raising=False)
+    with pytest.raises(SystemExit):
+        install(d, "lmod --freeze MOD1")
+
+def test_lmod_freeze_environment(d, monkeypatch):
+    calls = fake_lmod(d, monkeypatch, path=True)
+    kern = install(d, "lmod --freeze MOD1")
+    assert len(calls()) == 1
+    # A kernel started with another PATH must not get the PATH of setup.
+    monkeypatch.setenv('PATH', pjoin(d, 'userbin')+os.pathsep+os.environ['PATH'])
+    def test_exec(_file, argv):
+        assert os.environ['TEST_LMOD'] == 'load MOD1'
+        path = os.environ['PATH'].split(os.pathsep)
+        assert path[:2] == [pjoin(d, 'lmod', 'bin'), pjoin(d, 'userbin')]
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+
+def fake_spack(d, monkeypatch):
+    """Install a stand-in `spack` in $SPACK_ROOT/bin.
+
+    Each call is logged to $SPACK_ROOT/calls, and `load --sh` and
+    `env activate --sh` print a script setting TEST_SPACK."""
+    SPACK_ROOT = pjoin(d, 'spack')
+    os.makedirs(pjoin(SPACK_ROOT, 'bin'))
+    os.makedirs(pjoin(SPACK_ROOT, 'opt', 'spack', '.spack-db'))
+    with open(pjoin(SPACK_ROOT, 'opt', 'spack', '.spack-db', 'index.json'), 'w') as f:
+        f.write('{}')
+    script = pjoin(SPACK_ROOT, 'bin', 'spack')
+    open(script, 'w').write(
+        '#!/bin/sh\n'
+        'echo "$@" >> "$SPACK_ROOT/calls"\n'
+        'echo "export TEST_SPACK=\'$*\';"\n')
+    os.chmod(script, 0o755)
+    monkeypatch.setenv('SPACK_ROOT', SPACK_ROOT)
+    monkeypatch.setenv('PATH', pjoin(SPACK_ROOT, 'bin')+os.pathsep+os.environ['PATH'])
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    monkeypatch.delenv('TEST_SPACK', raising=False)
+    return lambda: open(pjoin(SPACK_ROOT, 'calls')).read().splitlines()
+
+def test_run_spack(d, monkeypatch):
+    calls = fake_spack(d, monkeypatch)
+    def test_exec(_file, argv):
+        assert os.environ['TEST_SPACK'] == 'load --sh py-numpy zlib'
+    kern = install(d, "spack py-numpy zlib")
+    assert kern['kernel']['display_name'] == 'Spack py-numpy zlib'
+    run(d, kern, test_exec)
+    del os.environ['TEST_SPACK']
+    run(d, kern, test_exec)
+    assert calls() == ['load --sh py-numpy zlib']
+    # Installing packages invalidates the cache
+    del os.environ['TEST_SPACK']
+    os.utime(pjoin(d, 'spack', 'opt', 'spack', '.spack-db', 'index.json'), (0, 0))
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+
+def test_run_spack_env(d, monkeypatch):
+    calls = fake_spack(d, monkeypatch)
+    def test_exec(_file, argv):
+        assert os.environ['TEST_SPACK'] == 'env activate --sh myenv'
+    kern = install(d, "spack --spack-env=myenv --no-cache")
+    run(d, kern, test_exec)
+    del os.environ['TEST_SPACK']
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+
+def fake_modules(d, names):
+    for name in names:
+        os.makedirs(os.path.dirname(pjoin(d, 'modules', name)), exist_ok=True)
+        open(pjoin(d, 'modules', name), 'w').close()
+
+def test_lmod_pin(d, monkeypatch):
+    fake_lmod(d, monkeypatch)
+    envkernel._module_index.clear()
+    fake_modules(d, ['GCC/9.3.lua', 'GCC/11.2.lua', 'Python/3.9.lua', 'Python/3.10.lua',
+                     'tools.lua', 'R/4.0.lua', 'R/4.1.lua'])
+    os.symlink('4.0.lua', pjoin(d, 'modules', 'R', 'default'))
+    kern = install(d, "lmod --pin --purge GCC Python/3.9 R tools -other")
+    assert kern['ek'][-5:] == ['GCC/11.2', 'Python/3.9', 'R/4.0', 'tools', '-other']
+    kern = install(d, "lmod --validate Python")
+    assert kern['ek'][-1] == 'Python'
+    with pytest.raises(SystemExit):
+        install(d, "lmod --validate Pyton")
+
+def test_lmod_spider(d, monkeypatch):
+    fake_lmod(d, monkeypatch)
+    envkernel._module_index.clear()
+    spider = pjoin(d, 'lmod', 'libexec', 'spider')
+    open(spider, 'w').write("#!/bin/sh\necho '%s'\n"%json.dumps([
+        {'package': 'GCC', 'versions': [{'full': 'GCC/9.3', 'markedDefault': True},
+                                        {'full': 'GCC/11.2'}]}]))
+    os.chmod(spider, 0o755)
+    assert envkernel.lmod_resolve(['GCC', 'GCC/11.2']) == {'GCC': 'GCC/9.3', 'GCC/11.2': 'GCC/11.2'}
+    with pytest.raises(RuntimeError, match='GCC'):
+        envkernel.lmod_resolve(['GCCcore'])
+
+def test_cache_evict(d):
+    for i in range(4):
+        envkernel.cached_env_delta('test', i, lambda: {'A': 'x'*400000},
+                                   directory=d, max_size=1)
+    assert len(os.listdir(pjoin(d, 'test'))) < 4*2
+    # The most recent entry is kept
+    assert envkernel.cached_env_delta('test', 3, lambda: None, directory=d)['A']
+
+def test_cache_evict_locks(d):
+    import threading
+    directory = pjoin(d, 'test')
+    os.mkdir(directory)
+    for name in ('a', 'b'):
+        open(pjoin(directory, name+'.json'), 'w').write('x'*1000)
+        open(pjoin(directory, name+'.lock'), 'w').close()
+    # A lock file someone holds is kept, others are removed with the entry
+    with envkernel.locked(pjoin(directory, 'a.lock')):
+        envkernel.cache_evict(directory, 0)
+    assert os.listdir(directory) == ['a.lock']
+    # Someone waiting for a lock file which is removed locks the new one
+    lock = envkernel.locked(pjoin(directory, 'a.lock'))
+    lock.acquire()
+    waiter = envkernel.locked(pjoin(directory, 'a.lock'))
+    t = threading.Thread(target=waiter.acquire)
+    t.start()
+    t.join(0.2)
+    os.unlink(lock.path)
+    lock.release()
+    t.join()
+    assert os.path.samestat(os.fstat(waiter.fd), os.stat(pjoin(directory, 'a.lock')))
+    waiter.release()
+
+def test_run_docker_host_network(d):
+    def test_exec(_file, argv):
+        assert '--network=host' in argv
+        assert '-p' not in argv
+        assert json.load(open(pjoin(d, 'connection.json')))['ip'] == '127.0.0.1'
+    kern = install(d, "docker --host-network IMAGE")
+    run(d, kern, test_exec)
+    # A port in use on the host: fall back to forwarding the ports
+    def test_exec_forward(_file, argv):
+        assert '--network=host' not in argv
+        assert is_sublist(argv, ['-p', '10002:10002'])
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 10002))
+        s.listen()
+        run(d, kern, test_exec_forward)
+
 def test_run_docker(d):
     def test_exec(_file, argv):
         assert argv[0:5] == ['docker', 'run', '--rm', '-i', '--user']
@@ -364,6 +1111,299 @@ def test_run_docker(d):
     kern = install(d, "docker --some-arg=AAA --workdir=/WORKDIR IMAGE")
     run(d, kern, test_exec)
 
+def fake_docker(d, monkeypatch, script=''):
+    """Put a stand-in `docker` command first on PATH.
+
+    Each call is logged to d/docker-calls, `docker run -d` prints a
+    container ID.  `script` is extra shell code to run first."""
+    bindir = pjoin(d, 'bin')
+    os.makedirs(bindir, exist_ok=True)
+    open(pjoin(bindir, 'docker'), 'w').write(
+        '#!/bin/sh\n'
+        '%s\n'
+        'echo "$*" >> %s/docker-calls\n'
+        'if [ "$1 $2" = "run -d" ]; then echo container-$(wc -l < %s/docker-calls); fi\n'%(script, d, d))
+    os.chmod(pjoin(bindir, 'docker'), 0o755)
+    monkeypatch.setenv('PATH', bindir+':'+os.environ['PATH'])
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    def calls():
+        if not os.path.exists(pjoin(d, 'docker-calls')):
+            return [ ]
+        return open(pjoin(d, 'docker-calls')).read().splitlines()
+    return calls
+
+def test_docker_pin_digest(d, monkeypatch):
+    # Local images are lines `NAME ID` in d/images (the last one of a
+    # name wins), pulling appends them from d/registry.
+    fake_docker(d, monkeypatch, script=(
+        'eval last=\\${$#}\n'
+        'case "$1 $2" in\n'
+        '  "image inspect") grep -e "^$last " -e " $last\\$" %s/images | tail -n1 | cut -d" " -f2 | grep .; exit;;\n'
+        '  "pull -q") grep "^$last " %s/registry >> %s/images; exit;;\n'
+        'esac'%(d, d, d)))
+    def set_images(fname, images):
+        open(pjoin(d, fname), 'w').write(''.join('%s %s\n'%x for x in images))
+    set_images('images', [ ])
+    with pytest.raises(SystemExit):
+        install(d, "docker --pin-digest IMAGE")
+    set_images('images', [('IMAGE', 'sha256:aaa')])
+    kern = install(d, "docker --pin-digest IMAGE")
+    assert is_sublist(kern['ek'], ['--image-name=IMAGE', 'sha256:aaa'])
+    assert kern['kernel']['display_name'] == 'Docker with IMAGE'
+    def test_exec(_file, argv):
+        assert '--pull=never' in argv
+        assert argv[argv.index('sha256:aaa')+1] == 'python'
+    run(d, kern, test_exec)
+    # --refresh pulls and pins the new image
+    set_images('registry', [('IMAGE', 'sha256:bbb')])
+    kern = install(d, "docker --refresh IMAGE")
+    assert 'sha256:bbb' in kern['ek']
+    # Starting doesn't check the image: with --pull=never, docker run
+    # fails if it is gone.
+    set_images('images', [ ])
+    def test_exec(_file, argv):
+        assert is_sublist(argv, ['--pull=never'])
+        assert 'sha256:bbb' in argv
+    run(d, kern, test_exec)
+
+def test_run_docker_pool(d, monkeypatch):
+    calls = fake_docker(d, monkeypatch)
+    # Refill synchronously, so that we can test it
+    monkeypatch.setattr(envkernel.docker, '_pool_refill_background',
+                        envkernel.docker._pool_refill)
+    kern = install(d, "docker --pool=2 IMAGE")
+    # Empty pool: normal start, and the pool gets filled
+    def test_exec(_file, argv):
+        assert argv[0:3] == ['docker', 'run', '--rm']
+    run(d, kern, test_exec)
+    assert len(calls()) == 2
+    assert all(x.startswith('run -d --rm --network=host') for x in calls())
+    assert all('IMAGE sh -c' in x for x in calls())
+    # Next start uses a container from the pool
+    def test_exec(_file, argv):
+        assert argv == ['docker', 'attach', '--sig-proxy=true', 'container-1']
+    run(d, kern, test_exec)
+    assert len(calls()) == 3
+    slot = [x for x in glob.glob(pjoin(d, 'cache/docker-pool/*/*')) if x.endswith('.claimed')][0]
+    run_sh = open(pjoin(slot, 'run.sh')).read()
+    assert run_sh.startswith('exec python -m ipykernel_launcher -f /envkernel-pool/connection.json')
+    assert json.load(open(pjoin(slot, 'connection.json')))['ip'] == '127.0.0.1'
+
+def test_run_docker_pool_fill_only(d, monkeypatch):
+    calls = fake_docker(d, monkeypatch)
+    # As from cron: no kernel command and no connection file
+    argv = ['envkernel', 'docker', 'run', '--pool=2', '--pool-fill-only', 'IMAGE']
+    assert envkernel.main(argv) == 0
+    assert len(calls()) == 2
+    assert all(x.startswith('run -d --rm --network=host') for x in calls())
+    assert envkernel.main(argv) == 0
+    assert len(calls()) == 2
+    # Pool containers need the host network
+    with pytest.raises(SystemExit):
+        envkernel.main(argv + ['--network=bridge'])
+    assert len(calls()) == 2
+
+def test_run_docker_pool_host_network(d, monkeypatch):
+    calls = fake_docker(d, monkeypatch)
+    monkeypatch.setattr(envkernel.docker, '_pool_refill_background',
+                        envkernel.docker._pool_refill)
+    def test_exec(_file, argv):
+        assert argv[0:3] == ['docker', 'run', '--rm']
+        assert '--network=host' not in argv
+    # Another network given: the pool is not used
+    kern = install(d, "docker --pool=2 --network=bridge IMAGE")
+    run(d, kern, test_exec)
+    assert calls() == [ ]
+    # A kernel port in use on the host: normal start with forwarded ports
+    kern = install(d, "docker --pool=2 IMAGE")
+    envkernel.main(['envkernel', 'docker', 'run', '--pool=2', '--pool-fill-only', 'IMAGE'])
+    assert len(calls()) == 2
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 10000))
+        s.listen()
+        def test_exec(_file, argv):
+            assert argv[0:3] == ['docker', 'run', '--rm']
+            assert is_sublist(argv, ['-p', '10000:10000'])
+        run(d, kern, test_exec)
+    assert len(calls()) == 2
+
+def fake_singularity(d, monkeypatch):
+    """Put a stand-in `singularity` command first on PATH.
+
+    Calls are logged to d/singularity-calls.  Started instances are
+    remembered and listed by `singularity instance list`."""
+    bindir = pjoin(d, 'bin')
+    os.makedirs(bindir, exist_ok=True)
+    open(pjoin(bindir, 'singularity'), 'w').write(
+        '#!/bin/sh\n'
+        'echo "$*" >> {d}/singularity-calls\n'
+        'for last; do :; done\n'
+        'case "$1 $2" in\n'
+        '  "instance start") echo $last >> {d}/instances ;;\n'
+        '  "instance list") cat {d}/instances 2> /dev/null ;;\n'
+        'esac\n'.format(d=d))
+    os.chmod(pjoin(bindir, 'singularity'), 0o755)
+    monkeypatch.setenv('PATH', bindir+':'+os.environ['PATH'])
+    monkeypatch.setenv('ENVKERNEL_CACHE_DIR', pjoin(d, 'cache'))
+    return lambda: open(pjoin(d, 'singularity-calls')).read().splitlines()
+
+def test_run_singularity_instance(d, monkeypatch):
+    calls = fake_singularity(d, monkeypatch)
+    watches = [ ]
+    monkeypatch.setattr(envkernel.singularity, '_instance_watch_background',
+                        lambda self, *args: watches.append(args))
+    kern = install(d, "singularity --instance --contain IMAGE")
+    def test_exec(_file, argv):
+        assert argv[:2] == ['singularity', 'exec']
+        assert argv[2].startswith('instance://envkernel-')
+        assert argv[-1] == '/envkernel-connection/connection.json'
+    run(d, kern, test_exec)
+    run(d, kern, test_exec)
+    # Started only once
+    assert [x.split()[:2] for x in calls()].count(['instance', 'start']) == 1
+    start = [x for x in calls() if x.startswith('instance start')][0].split()
+    assert '--contain' in start
+    assert start[-2] == os.path.join(os.getcwd(), 'IMAGE')
+    instance_dir, name, pid, connection_copy, grace = watches[0]
+    assert json.load(open(connection_copy))['ip'] == '127.0.0.1'
+    # It contains the kernel's key
+    assert os.stat(connection_copy).st_mode & 0o777 == 0o600
+    assert os.stat(os.path.dirname(connection_copy)).st_mode & 0o777 == 0o700
+    # After the kernels exit, the instance is stopped
+    for fname in os.listdir(pjoin(instance_dir, 'pids')):
+        os.rename(pjoin(instance_dir, 'pids', fname), pjoin(instance_dir, 'pids', '999999999'))
+    envkernel.singularity([])._instance_watch(instance_dir, name, 999999999, connection_copy, 0)
+    assert calls()[-1] == 'instance stop %s'%name
+    assert not os.path.exists(connection_copy)
+
+TEST_CONNECTION_FILE_IPC = TEST_CONNECTION_FILE.replace(
+    '"ip": "127.0.0.1"', '"ip": "SOCKETDIR/kernel-ipc"').replace('"tcp"', '"ipc"')
+
+def test_run_docker_ipc(d, monkeypatch):
+    connection = TEST_CONNECTION_FILE_IPC.replace('SOCKETDIR', d)
+    def test_exec(_file, argv):
+        assert '-p' not in argv
+        assert is_sublist(argv, ["--mount", "type=bind,source=%s,destination=%s,ro=false"%(d, d)])
+        assert json.load(open(pjoin(d, 'connection.json')))['ip'] == pjoin(d, 'kernel-ipc')
+    kern = install(d, "docker IMAGE")
+    run(d, kern, test_exec, connection=connection)
+    # A relative ip (jupyter_client's default) is made absolute
+    monkeypatch.chdir(d)
+    run(d, kern, test_exec, connection=TEST_CONNECTION_FILE_IPC.replace('SOCKETDIR/', ''))
+
+def make_workdir(d):
+    work = pjoin(d, 'work')
+    os.makedirs(pjoin(work, 'sub'))
+    os.makedirs(pjoin(work, '.git'))
+    open(pjoin(work, 'a.txt'), 'w').write('A')
+    open(pjoin(work, 'sub', 'b.dat'), 'w').write('B'*1000)
+    open(pjoin(work, '.git', 'HEAD'), 'w').write('ref')
+    os.symlink('a.txt', pjoin(work, 'link'))
+    return work
+
+def test_run_docker_copy(d, monkeypatch):
+    work = make_workdir(d)
+    monkeypatch.chdir(work)
+    cleanups = [ ]
+    monkeypatch.setattr(envkernel.docker, 'cleanup_after_exit',
+                        lambda self, paths: cleanups.extend(paths))
+    mounts = [ ]
+    def test_exec(_file, argv):
+        mount = [x for x in argv if x.startswith('type=bind,source=') and 'destination=/work' in x]
+        assert ',copy' not in mount[0]
+        mounts.append(mount[0].split(',')[1].split('=')[1])
+    kern = install(d, "docker --pwd --copy-workdir --workdir=/work --copy-exclude=.git IMAGE")
+    run(d, kern, test_exec)
+    copy = mounts[0]
+    assert copy != work
+    assert open(pjoin(copy, 'sub', 'b.dat')).read() == 'B'*1000
+    assert os.readlink(pjoin(copy, 'link')) == 'a.txt'
+    assert not os.path.exists(pjoin(copy, '.git'))
+    assert cleanups == [os.path.dirname(copy)]
+
+    # Too big: nothing is left behind
+    copy_dir = pjoin(d, 'copies')
+    os.mkdir(copy_dir)
+    kern = install(d, "docker --pwd --copy-workdir --workdir=/work --copy-max-size=0 "
+                      "--copy-dir=%s IMAGE"%copy_dir)
+    with pytest.raises(RuntimeError):
+        run(d, kern, test_exec)
+    assert os.listdir(copy_dir) == [ ]
+
+def test_stage_tree(d):
+    work = make_workdir(d)
+    for method in ['auto', 'hardlink', 'copy']:
+        dst = pjoin(d, method)
+        envkernel.stage_tree(work, dst, method=method, exclude=['sub/*'])
+        assert sorted(os.listdir(dst)) == ['.git', 'a.txt', 'link', 'sub']
+        assert os.listdir(pjoin(dst, 'sub')) == [ ]
+        same = os.stat(pjoin(dst, 'a.txt')).st_ino == os.stat(pjoin(work, 'a.txt')).st_ino
+        assert same == (method == 'hardlink')
+
+def test_run_singularity_ipc(d, monkeypatch):
+    cleanups = [ ]
+    monkeypatch.setattr(envkernel.singularity, 'cleanup_after_exit',
+                        lambda self, paths: cleanups.extend(paths))
+    connection = TEST_CONNECTION_FILE_IPC.replace('SOCKETDIR', d)
+    def test_exec(_file, argv):
+        assert is_sublist(argv, ['--bind', d+':/envkernel-ipc'])
+        assert argv[-1] == '/envkernel-ipc/envkernel-connection.json'
+        new = json.load(open(pjoin(d, 'envkernel-connection.json')))
+        assert new['ip'] == '/envkernel-ipc/kernel-ipc'
+        assert new['transport'] == 'ipc'
+        assert (os.stat(pjoin(d, 'envkernel-connection.json')).st_mode & 0o777
+                == 0o600)
+    kern = install(d, "singularity --contain IMAGE")
+    run(d, kern, test_exec, connection=connection)
+    assert cleanups == [pjoin(d, 'envkernel-connection.json')]
+
+
+def test_run_singularity_stage(d, monkeypatch):
+    monkeypatch.setenv('ENVKERNEL_STAGE_DIR', pjoin(d, 'stage'))
+    image = pjoin(d, 'image.sif')
+    open(image, 'wb').write(b'x'*1000)
+    staged = [ ]
+    def test_exec(_file, argv):
+        path = argv[argv.index('python')-1]
+        assert path.startswith(pjoin(d, 'stage', 'singularity'))
+        assert open(path, 'rb').read() == open(image, 'rb').read()
+        staged.append(path)
+    kern = install(d, "singularity --stage %s"%image)
+    run(d, kern, test_exec)
+    run(d, kern, test_exec)
+    assert staged[0] == staged[1]
+    # A copy which was planted (here: a symlink) is not used, but replaced
+    open(pjoin(d, 'planted'), 'wb').write(b'planted')
+    os.unlink(staged[0])
+    os.symlink(pjoin(d, 'planted'), staged[0])
+    run(d, kern, test_exec)
+    assert not os.path.islink(staged[0])
+    # Too big to stage
+    kern = install(d, "singularity --stage --stage-size=0 %s"%image)
+    def test_exec_direct(_file, argv):
+        assert image in argv
+    run(d, kern, test_exec_direct)
+    # A changed image is copied again
+    open(image, 'wb').write(b'z'*1000)
+    kern = install(d, "singularity --stage-checksum %s"%image)
+    run(d, kern, test_exec)
+    assert len(glob.glob(pjoin(d, 'stage', 'singularity', '*.img'))) == 2
+    # A checksum mismatch uses the image directly
+    open(image, 'wb').write(b'w'*1000)
+    run(d, kern, test_exec_direct)
+    # Copies used in the last seconds are not evicted, even if over the
+    # limit, since a start may be about to open them.
+    copies = glob.glob(pjoin(d, 'stage', 'singularity', '*.img'))
+    envkernel.stage_file(image, pjoin(d, 'stage', 'singularity'), max_size=2500/2**20)
+    assert set(copies) < set(glob.glob(pjoin(d, 'stage', 'singularity', '*.img')))
+    # Otherwise, the least recently used copies are evicted to make space
+    for i, copy in enumerate(glob.glob(pjoin(d, 'stage', 'singularity', '*.img'))):
+        os.utime(copy, (1000+i, 1000+i))
+    os.utime(staged[-1], (2000, 2000))
+    open(image, 'wb').write(b'v'*1000)
+    envkernel.stage_file(image, pjoin(d, 'stage', 'singularity'), max_size=2500/2**20)
+    assert len(glob.glob(pjoin(d, 'stage', 'singularity', '*.img'))) == 2
+    assert staged[-1] in glob.glob(pjoin(d, 'stage', 'singularity', '*.img'))
 
 def test_run_singularity(d):
     def test_exec(_file, argv):